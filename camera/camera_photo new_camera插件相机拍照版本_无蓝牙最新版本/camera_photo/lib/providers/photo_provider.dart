@@ -273,7 +273,7 @@ class PhotoProvider with ChangeNotifier {
           var streamedResponse = await request.send();
           var response = await http.Response.fromStream(streamedResponse);
 
-          if (response.statusCode == 200) {
+          if (response.statusCode >= 200 && response.statusCode < 300) {
             completed++;
             _uploadProgress = completed / total;
             notifyListeners();
@@ -353,7 +353,7 @@ class PhotoProvider with ChangeNotifier {
           var streamedResponse = await request.send();
           var response = await http.Response.fromStream(streamedResponse);
 
-          if (response.statusCode == 200) {
+          if (response.statusCode >= 200 && response.statusCode < 300) {
             completed++;
             _uploadProgress = completed / total;
             notifyListeners();
@@ -525,7 +525,7 @@ class PhotoProvider with ChangeNotifier {
       var response = await request.send();
       var responseData = await response.stream.bytesToString();
 
-      if (response.statusCode == 200) {
+      if (response.statusCode >= 200 && response.statusCode < 300) {
         _uploadStatus = '上传成功！';
       } else {
         _uploadStatus = '上传失败: ${response.statusCode}';
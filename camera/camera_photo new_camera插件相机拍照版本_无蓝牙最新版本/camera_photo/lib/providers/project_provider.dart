@@ -843,7 +843,7 @@ class ProjectProvider with ChangeNotifier {
       final responseData = await response.stream.bytesToString();
       print('Batch upload response: $responseData');  // 调试信息
 
-      if (response.statusCode == 200) {
+      if (response.statusCode >= 200 && response.statusCode < 300) {
         return BatchUploadResult(success: true, filesCount: batch.length);
       } else {
         print('Batch upload failed: ${response.statusCode}, $responseData');
@@ -1393,7 +1393,7 @@ class ProjectProvider with ChangeNotifier {
         var response = await request.send().timeout(Duration(seconds: 60));
         var responseData = await response.stream.bytesToString();
         
-        if (response.statusCode == 200) {
+        if (response.statusCode >= 200 && response.statusCode < 300) {
           try {
             var responseJson = json.decode(responseData);
             
@@ -1100,7 +1100,7 @@ class ProjectProvider with ChangeNotifier {
       final response = await request.send();
       final responseData = await response.stream.bytesToString();
       
-      if (response.statusCode == 200) {
+      if (response.statusCode >= 200 && response.statusCode < 300) {
         if (status != null) {
           status.addLog('批次 $batchNumber 上传成功');
           _uploadStatuses[project.id] = status;
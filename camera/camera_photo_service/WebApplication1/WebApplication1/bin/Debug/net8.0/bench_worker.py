@@ -0,0 +1,87 @@
+import sys
+import os
+import json
+import time
+import argparse
+import socket
+import subprocess
+import statistics
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    return {
+        "mode": name,
+        "calls": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 3)
+    }
+
+def bench_oneshot(calls):
+    """每次调用启动一个新进程（当前C#的调用方式）"""
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, SCRIPT, "success", str(i)],
+                                capture_output=True, text=True, encoding="utf-8").stdout
+        json.loads(output)
+        latencies.append(time.perf_counter() - start)
+    return summarize("oneshot", latencies)
+
+def bench_stdin(calls):
+    """一个常驻进程，通过标准输入输出逐个请求"""
+    process = subprocess.Popen([sys.executable, SCRIPT, "--worker"], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding="utf-8")
+    latencies = []
+    try:
+        for i in range(calls):
+            start = time.perf_counter()
+            process.stdin.write(json.dumps({"id": i, "params": ["success", str(i)]}) + "\n")
+            process.stdin.flush()
+            assert json.loads(process.stdout.readline())["id"] == i
+            latencies.append(time.perf_counter() - start)
+    finally:
+        process.stdin.close()
+        process.wait()
+    return summarize("worker-stdin", latencies)
+
+def bench_socket(calls, path, port):
+    """一个常驻进程，通过Unix域套接字（没有时用本机TCP端口）逐个请求"""
+    if hasattr(socket, "AF_UNIX"):
+        command, family, address = ["--socket", path], socket.AF_UNIX, path
+    else:
+        command, family, address = ["--port", str(port)], socket.AF_INET, ("127.0.0.1", port)
+    process = subprocess.Popen([sys.executable, SCRIPT] + command, stderr=subprocess.DEVNULL)
+    try:
+        latencies = []
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            # 等待常驻进程开始监听
+            while True:
+                try:
+                    sock.connect(address)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    time.sleep(0.01)
+            reader = sock.makefile("r", encoding="utf-8")
+            for i in range(calls):
+                start = time.perf_counter()
+                sock.sendall((json.dumps({"id": i, "params": ["success", str(i)]}) + "\n").encode("utf-8"))
+                assert json.loads(reader.readline())["id"] == i
+                latencies.append(time.perf_counter() - start)
+    finally:
+        process.terminate()
+        process.wait()
+    return summarize("worker-socket", latencies)
+
+if __name__ == "__main__":
+    # 比较一次性调用与常驻模式的单次调用延迟，结果以JSON输出
+    parser = argparse.ArgumentParser(description="main.py 调用方式延迟对比")
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--socket", default="/tmp/ply_worker_bench.sock")
+    parser.add_argument("--port", type=int, default=8765, help="没有Unix域套接字时使用的本机TCP端口")
+    args = parser.parse_args()
+
+    results = [bench_oneshot(args.calls), bench_stdin(args.calls), bench_socket(args.calls, args.socket, args.port)]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
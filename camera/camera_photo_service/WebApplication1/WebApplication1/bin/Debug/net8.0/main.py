@@ -1,5 +1,15 @@
 import sys
 import json
+import os
+import argparse
+import signal
+import socket
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+WORKER_THREADS = 4  # 常驻模式下同时处理的请求数
+WORKER_PORT = 8765  # 没有Unix域套接字的平台（Windows）上，常驻模式监听的本机TCP端口
 
 def some_function(param1, param2):
     """
@@ -10,7 +20,7 @@ def some_function(param1, param2):
     try:
         # 这里放置业务逻辑，使用传入的参数
         print(f"接收到参数: param1={param1}, param2={param2}", file=sys.stderr)
-        
+
         # 示例逻辑：如果param1等于"success"则返回成功，否则返回失败
         if param1 == "success":
             status_code = 1
@@ -18,37 +28,139 @@ def some_function(param1, param2):
         else:
             status_code = 2
             result_str = f"操作失败，参数值: {param1}, {param2}"
-        
+
         return status_code, result_str
     except Exception as e:
         # 异常处理
         return 2, f"发生错误: {str(e)}"
 
+def handle_request(line):
+    """
+    处理一行JSON请求，返回JSON响应字符串。
+    请求格式: {"id": 请求ID, "param1": ..., "param2": ...}，也可以用 "params": [p1, p2]
+    响应格式: {"id": 请求ID, "status_code": ..., "message": ...}
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+        params = request.get("params") or [request.get("param1", "default1"), request.get("param2", "default2")]
+        params = list(params) + ["default1", "default2"][len(params):]
+        status_code, result_str = some_function(str(params[0]), str(params[1]))
+    except Exception as e:
+        status_code, result_str = 2, f"请求格式错误: {str(e)}"
+    return json.dumps({"id": request_id, "status_code": status_code, "message": result_str}, ensure_ascii=False)
+
+def serve_stdin(threads):
+    """从标准输入逐行读取请求，处理完成后按完成顺序写回标准输出（用id对应）"""
+    write_lock = Lock()
+
+    def reply(future):
+        with write_lock:
+            sys.stdout.write(future.result() + "\n")
+            sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for line in sys.stdin:
+            if line.strip():
+                pool.submit(handle_request, line).add_done_callback(reply)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """套接字连接（Unix域或本机TCP）：一个连接上可以连续发送多个请求，响应按完成顺序返回"""
+
+    def handle(self):
+        write_lock = Lock()
+
+        def reply(future):
+            with write_lock:
+                try:
+                    self.wfile.write((future.result() + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                except OSError:
+                    pass  # 客户端已断开
+
+        futures = []
+        for line in self.rfile:
+            if line.strip():
+                future = self.server.pool.submit(handle_request, line.decode("utf-8"))
+                future.add_done_callback(reply)
+                futures.append(future)
+        # 连接关闭前等待本连接的请求全部写回
+        for future in futures:
+            future.exception()
+
+class TcpWorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve_socket(path, threads, port=WORKER_PORT):
+    """
+    在Unix域套接字上提供常驻服务。
+    path 为空或平台没有Unix域套接字（Windows）时改为监听 127.0.0.1:port。
+    """
+    if path and hasattr(socket, "AF_UNIX"):
+        class UnixWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(path):
+            os.remove(path)
+        server, address = UnixWorkerServer(path, RequestHandler), path
+    else:
+        server = TcpWorkerServer(("127.0.0.1", port), RequestHandler)
+        address, path = "%s:%d" % server.server_address[:2], None
+    with ThreadPoolExecutor(max_workers=threads) as pool, server:
+        server.pool = pool
+        # 被终止时也删除套接字文件
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"常驻模式已启动: {address}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            if path:
+                os.remove(path)
+
+def parse_worker_args():
+    parser = argparse.ArgumentParser(description="C#调用的Python脚本（常驻模式）")
+    parser.add_argument("--worker", action="store_true", help="从标准输入逐行读取JSON请求")
+    parser.add_argument("--socket", help="在该路径的Unix域套接字上接收请求（Windows下改用 --port 指定的本机TCP端口）")
+    parser.add_argument("--port", type=int, help=f"在本机TCP端口上接收请求，默认 {WORKER_PORT}")
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS, help="同时处理的请求数")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    # 获取命令行参数
+    # 常驻调用：python main.py --worker、python main.py --socket /tmp/ply_worker.sock 或 python main.py --port 8765
+    if len(sys.argv) > 1 and sys.argv[1] in ("--worker", "--socket", "--port"):
+        args = parse_worker_args()
+        if args.socket or args.port:
+            serve_socket(args.socket, args.threads, args.port or WORKER_PORT)
+        else:
+            serve_stdin(args.threads)
+        sys.exit(0)
+
+    # 一次性调用：python main.py <param1> <param2>，输出一行JSON并以状态码退出
     # sys.argv[0]是脚本名称，sys.argv[1]开始是传入的参数
-    
+
     # 设置默认参数值
     param1 = "default1"
     param2 = "default2"
-    
+
     # 检查是否有足够的参数
     if len(sys.argv) > 1:
         param1 = sys.argv[1]
     if len(sys.argv) > 2:
         param2 = sys.argv[2]
-    
+
     # 调用函数，传入参数
     status_code, result_str = some_function(param1, param2)
-    
+
     # 创建结果字典
     result = {
-        "status_code": param1,
+        "status_code": status_code,
         "message": result_str
     }
-    
+
     # 输出JSON结果
     print(json.dumps(result, ensure_ascii=False))
-    
+
     # 设置退出码
-    sys.exit(status_code)
\ No newline at end of file
+    sys.exit(status_code)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class PlyArchiveCache:
+    """
+    PLY压缩包缓存。
+    以输入文件集合的指纹（排序后的 文件名、大小、修改时间、SHA-256 以及打包参数）为键，
+    在磁盘上保留已构建的压缩包，总大小超过上限时按最近最少使用淘汰。
+    索引保存在 index.json 中，服务重启后缓存仍然有效。
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.hash_memo = {}  # 路径 -> (大小, 修改时间, SHA-256)，未变化的文件不重复计算
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(folder, exist_ok=True)
+        self.index_path = os.path.join(folder, 'index.json')
+        self.entries = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        # 丢弃文件已不存在的条目
+        return {key: e for key, e in entries.items() if os.path.exists(os.path.join(self.folder, e['file']))}
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _file_hash(self, path, st):
+        memo = self.hash_memo.get(path)
+        if memo and memo[:2] == (st.st_size, st.st_mtime_ns):
+            return memo[2]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        self.hash_memo[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def fingerprint(self, files, settings=None):
+        """计算输入文件集合的指纹"""
+        items = []
+        for path in sorted(files, key=os.path.basename):
+            st = os.stat(path)
+            items.append([os.path.basename(path), st.st_size, st.st_mtime_ns, self._file_hash(path, st)])
+        payload = json.dumps({'files': items, 'settings': settings or {}}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """查找缓存，命中时返回 (压缩包路径, 元数据)，否则返回 None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            path = os.path.join(self.folder, entry['file']) if entry else None
+            if not entry or not os.path.exists(path):
+                self.entries.pop(key, None)
+                self.stats['misses'] += 1
+                return None
+            entry['last_access'] = time.time()
+            self.stats['hits'] += 1
+            self._save_index()
+            return path, entry['meta']
+
+    def put(self, key, zip_path, meta=None):
+        """
+        将新构建的压缩包移入缓存并返回缓存中的路径。
+        压缩包本身超过缓存上限时不缓存，返回 None，由调用方自行清理。
+        """
+        size = os.path.getsize(zip_path)
+        if size > self.max_bytes:
+            return None
+        file_name = f'{key}.zip'
+        path = os.path.join(self.folder, file_name)
+        os.replace(zip_path, path)
+        with self.lock:
+            self.entries[key] = {'file': file_name, 'size': size, 'meta': meta or {}, 'last_access': time.time()}
+            self._evict(keep=key)
+            self._save_index()
+        return path
+
+    def _evict(self, keep):
+        """按最近访问时间淘汰，直到总大小不超过上限"""
+        total = sum(e['size'] for e in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            path = os.path.join(self.folder, entry['file'])
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                # 文件可能正被发送线程读取（Windows下无法删除），下次再淘汰
+                logger.warning(f"淘汰PLY压缩包缓存失败 {entry['file']}: {str(e)}")
+                continue
+            del self.entries[key]
+            total -= entry['size']
+            self.stats['evictions'] += 1
+            logger.info(f"淘汰PLY压缩包缓存: {entry['file']}")
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        total_bytes=sum(e['size'] for e in self.entries.values()),
+                        max_bytes=self.max_bytes)
@@ -0,0 +1,170 @@
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 每个项目一行：
+#   received_mask   已收到批次的位图，第 n 个批次对应第 n-1 位
+#   received_count  位图中已置位的数量，每次置位时加一，判断是否收齐不需要遍历位图
+#   task_id         收齐时触发PLY处理的任务ID，非空表示已收齐
+#   expires_at      过期时间，按它建索引，清理时只访问已过期的行
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS batch_progress (
+    project_key TEXT PRIMARY KEY,
+    project_name TEXT,
+    total_batches INTEGER NOT NULL,
+    received_mask BLOB NOT NULL,
+    received_count INTEGER NOT NULL DEFAULT 0,
+    saved_files INTEGER NOT NULL DEFAULT 0,
+    task_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_batch_progress_expires ON batch_progress (expires_at);
+'''
+
+
+def missing_batches(mask, total_batches):
+    """位图中未置位的批次号"""
+    return [n for n in range(1, total_batches + 1) if not mask[(n - 1) >> 3] & (1 << ((n - 1) & 7))]
+
+
+class BatchStore:
+    """
+    项目批次进度，保存在SQLite中，多个HTTP工作进程共享。
+
+    - 每个项目用位图记录收到了哪些批次，乱序到达和重传的批次不会重复计数，
+      收齐所有批次时（不要求最后编号的批次最后到达）触发一次PLY处理。
+    - 收齐的记录保留 replay_window 秒，期间重传的批次返回同一个任务ID而不再触发。
+    - 过期清理按 expires_at 索引从最早过期的行开始删除，不扫描全部记录；
+      跟踪的项目数超过 max_projects 时淘汰最早过期的项目。
+    """
+
+    def __init__(self, db_path, ttl=24 * 3600, replay_window=600, max_projects=10000):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.replay_window = replay_window
+        self.max_projects = max_projects
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def add_batch(self, project_key, project_name, batch_number, total_batches, saved_files, task_id):
+        """
+        记录项目收到第 batch_number 个批次，返回进度：
+            received   已收到的不同批次数
+            complete   项目是否已收齐
+            triggered  是否由本次调用收齐（每轮上传只有一次调用为真）
+            duplicate  该批次此前已收到
+            task_id    收齐时的PLY任务ID（本次触发时即为传入的 task_id）
+            missing    未收到的批次号，仅在收到最后编号的批次但尚未收齐时给出
+        """
+        if not 1 <= batch_number <= total_batches:
+            raise ValueError(f'批次号超出范围: {batch_number}/{total_batches}')
+        now = time.time()
+        byte_index, bit = (batch_number - 1) >> 3, 1 << ((batch_number - 1) & 7)
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._expire(conn, now)
+                row = conn.execute('SELECT * FROM batch_progress WHERE project_key = ?',
+                                   (project_key,)).fetchone()
+                if row is not None and row['total_batches'] != total_batches:
+                    # 总批次数变化，客户端重新开始上传
+                    row = None
+                if row is None:
+                    self._make_room(conn)
+                    mask = bytearray((total_batches + 7) >> 3)
+                    received = files = 0
+                    completed_task = None
+                    created = now
+                else:
+                    mask = bytearray(row['received_mask'])
+                    received = row['received_count']
+                    files = row['saved_files']
+                    completed_task = row['task_id']
+                    created = row['created_at']
+
+                duplicate = bool(mask[byte_index] & bit)
+                if not duplicate:
+                    mask[byte_index] |= bit
+                    received += 1
+                files += saved_files
+                triggered = completed_task is None and received == total_batches
+                if triggered:
+                    completed_task = task_id
+                expires_at = now + (self.replay_window if completed_task else self.ttl)
+                conn.execute(
+                    'INSERT OR REPLACE INTO batch_progress (project_key, project_name, total_batches, '
+                    'received_mask, received_count, saved_files, task_id, created_at, updated_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (project_key, project_name, total_batches, bytes(mask), received, files, completed_task,
+                     created, now, expires_at)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        progress = {
+            'received': received,
+            'complete': completed_task is not None,
+            'triggered': triggered,
+            'duplicate': duplicate,
+            'task_id': completed_task
+        }
+        if triggered:
+            logger.info(f"项目批次已收齐: {project_key}, 批次: {received}/{total_batches}, 文件: {files}")
+        elif duplicate:
+            logger.info(f"重复的批次: {project_key}, 批次: {batch_number}/{total_batches}")
+        if not completed_task and batch_number == total_batches:
+            progress['missing'] = missing_batches(mask, total_batches)
+        return progress
+
+    def _expire(self, conn, now):
+        """删除已过期的项目（按 expires_at 索引只访问过期的行）"""
+        deleted = conn.execute('DELETE FROM batch_progress WHERE expires_at <= ?', (now,)).rowcount
+        if deleted:
+            logger.info(f"清理过期项目批次记录: {deleted} 个")
+
+    def _make_room(self, conn):
+        """跟踪的项目数达到上限时淘汰最早过期的项目，为新项目腾出位置"""
+        excess = conn.execute('SELECT COUNT(*) FROM batch_progress').fetchone()[0] - self.max_projects + 1
+        if excess <= 0:
+            return
+        evicted = conn.execute(
+            'DELETE FROM batch_progress WHERE project_key IN '
+            '(SELECT project_key FROM batch_progress ORDER BY expires_at LIMIT ?)',
+            (excess,)
+        ).rowcount
+        logger.warning(f"跟踪的项目数已达上限 {self.max_projects}，淘汰最早过期的项目: {evicted} 个")
+
+    def next_expiry(self):
+        """最早的过期时间，没有记录时返回 None"""
+        with self._connect() as conn:
+            return conn.execute('SELECT MIN(expires_at) FROM batch_progress').fetchone()[0]
+
+    def expire(self):
+        """清理已过期的项目"""
+        with self._connect() as conn:
+            self._expire(conn, time.time())
+
+    def counts(self):
+        """正在接收批次的项目数和已收齐（保留用于识别重传）的项目数"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT COUNT(*) - COUNT(task_id) AS pending, COUNT(task_id) AS completed FROM batch_progress'
+            ).fetchone()
+            return {'pending': row['pending'], 'completed': row['completed'], 'max_projects': self.max_projects}
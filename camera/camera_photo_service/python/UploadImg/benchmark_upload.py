@@ -0,0 +1,423 @@
+"""
+/upload 压测工具。
+
+生成随机内容的JPEG批次，按指定并发和批次模式请求 /upload，输出JSON格式的结果
+（req/s、MB/s、p50/p95/p99延迟、服务端和压测端各自的峰值RSS），便于在不同改动之间比较。
+
+默认在子进程中启动被测服务（waitress），本进程运行一个最小的MQTT服务端替身，不需要手机和mosquitto：
+    python benchmark_upload.py --requests 200 --concurrency 8 --files-per-batch 10
+也可以压测已经运行的服务（此时不启动MQTT替身，不统计服务端RSS）：
+    python benchmark_upload.py --url http://192.168.1.10:5000
+请求按计划顺序由各连接依次领取，请求体在发送前才构造，压测端内存不随请求数增长。
+"""
+import argparse
+import asyncio
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+
+# 批次模式：
+#   sequential   每个项目的批次按 1..N 顺序发送，项目之间并发
+#   interleaved  各项目的批次轮流发送
+#   out-of-order 每个项目的批次打乱顺序发送，并按 --retry-rate 在之后重传部分批次（模拟响应丢失后的重发）
+#   final-only   每个请求都是 1/1 的最后批次，每次都会触发PLY任务
+# 所有模式都按计划顺序分派请求，并发连接数大于1时相邻请求会同时进行
+BATCH_PATTERNS = ('sequential', 'interleaved', 'out-of-order', 'final-only')
+
+
+class FakeMqttBroker:
+    """
+    进程内的最小MQTT服务端替身（支持 MQTT 3.1.1 和 5.0 的 CONNECT/PUBLISH/SUBSCRIBE/PING），
+    只接收并计数，不转发消息。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.messages = 0
+        self.bytes = 0
+        self.loop = None
+        self.server = None
+        self.ready = None
+
+    def start(self):
+        from threading import Event
+        self.ready = Event()
+        Thread(target=self._run, daemon=True, name='fake-mqtt').start()
+        self.ready.wait()
+        return self.port
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header[0], await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        version = 4
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    name_length = int.from_bytes(body[0:2], 'big')
+                    version = body[2 + name_length]
+                    writer.write(b'\x20\x03\x00\x00\x00' if version == 5 else b'\x20\x02\x00\x00')
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_length = int.from_bytes(body[0:2], 'big')
+                    self.messages += 1
+                    self.bytes += len(body)
+                    if qos:
+                        packet_id = body[2 + topic_length:4 + topic_length]
+                        writer.write(b'\x40\x02' + packet_id)
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id = body[0:2]
+                    if version == 5:
+                        writer.write(b'\x90\x04' + packet_id + b'\x00\x00')
+                    else:
+                        writer.write(b'\x90\x03' + packet_id + b'\x00')
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_jpeg(width, height, quality, seed):
+    """生成随机噪声JPEG（噪声图压缩率低，大小接近手机照片的量级）"""
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def build_multipart(fields, files):
+    """构造 multipart/form-data 请求体，返回 (content_type, body)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="files[]"; filename="{filename}"\r\n'
+                     f'Content-Type: image/jpeg\r\n\r\n'.encode())
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return f'multipart/form-data; boundary={boundary}', b''.join(parts)
+
+
+def plan_requests(args):
+    """按批次模式生成请求列表 [(项目名, 批次号, 总批次数)]，请求按列表顺序分派"""
+    if args.pattern == 'final-only':
+        return [(f'bench_{i}', 1, 1) for i in range(args.requests)]
+    projects = max(1, args.requests // args.batches)
+    plan = [[(f'bench_{p}', b, args.batches) for b in range(1, args.batches + 1)] for p in range(projects)]
+    if args.pattern == 'sequential':
+        return [item for project in plan for item in project]
+    if args.pattern == 'out-of-order':
+        rng = random.Random(args.seed)
+        items = []
+        for project in plan:
+            batches = list(project)
+            rng.shuffle(batches)
+            retries = [item for item in batches if rng.random() < args.retry_rate]
+            items.extend(batches + retries)
+        return items
+    return [project[b] for b in range(args.batches) for project in plan]
+
+
+def build_body(args, images, index, item):
+    """构造第 index 个请求的请求体，返回 (content_type, body)"""
+    project, batch_number, total_batches = item
+    files = [(f'{project}_{batch_number}_{i}.jpg', images[(index + i) % len(images)])
+             for i in range(args.files_per_batch)]
+    fields = {
+        'type': args.upload_type,
+        'value': 'benchmark',
+        'batch_number': batch_number,
+        'total_batches': total_batches,
+        'project_info': json.dumps({'name': project}),
+    }
+    for i, (name, _) in enumerate(files):
+        fields[f'file_info_{i}'] = json.dumps({'type': 'image', 'relativePath': name})
+    return build_multipart(fields, files)
+
+
+def start_local_server(args, broker_port):
+    """在临时目录中启动被测服务，返回 (地址, 停止函数, 工作目录, 服务模块)"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    original_cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='upload_bench_')
+    os.chdir(workdir)
+    os.makedirs('ply_output')
+
+    import main
+    main.MQTT_BROKER = '127.0.0.1'
+    main.MQTT_PORT = broker_port
+    main.PLY_CHECK_PATH = os.path.abspath('ply_output')
+    main.PLY_WATCH = False
+    app = main.create_app()
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # 请求排队的告警在压测时是预期的
+    main.start_job_workers(main.JOB_WORKERS)
+    Thread(target=main.run_mqtt_client, daemon=True).start()
+
+    from waitress import create_server
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = create_server(app, host='127.0.0.1', port=port, threads=os.cpu_count() * 2)
+    Thread(target=server.run, daemon=True, name='bench-server').start()
+
+    def stop():
+        # 等待PLY任务和发件箱处理完，再让任务线程停止轮询，之后才能删除工作目录
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            counts = main.job_queue.counts()
+            if not counts.get('queued') and not counts.get('running') and \
+                    not main.mqtt_outbox.snapshot()['queue_depth']:
+                break
+            time.sleep(0.05)
+        poll_interval = main.JOB_POLL_INTERVAL
+        main.JOB_POLL_INTERVAL = 3600
+        time.sleep(poll_interval + 0.1)
+        server.close()
+        for handler in logging.getLogger().handlers:
+            handler.close()
+        os.chdir(original_cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return f'http://127.0.0.1:{port}', stop, workdir, main
+
+
+def run_load(url, args, images, plan):
+    """
+    按并发数发送请求：各连接按计划顺序依次领取下一个请求，请求体在发送前构造。
+    返回 (耗时, 延迟列表, 状态码计数, 错误列表, 发送字节数)。
+    """
+    target = urlsplit(url)
+    path = (target.path.rstrip('/') or '') + '/upload'
+    latencies = []
+    status_codes = {}
+    errors = []
+    sent = [0]
+    next_index = [0]
+    lock = Lock()
+
+    def take():
+        with lock:
+            index = next_index[0]
+            next_index[0] += 1
+        return index if index < len(plan) else None
+
+    def worker():
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=300)
+        while True:
+            index = take()
+            if index is None:
+                break
+            content_type, body = build_body(args, images, index, plan[index])
+            start = time.perf_counter()
+            try:
+                connection.request('POST', path, body=body,
+                                   headers={'Content-Type': content_type, 'Content-Length': str(len(body))})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except Exception as e:
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=300)
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                status_codes[status] = status_codes.get(status, 0) + 1
+                sent[0] += len(body)
+        connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    return time.perf_counter() - start, latencies, status_codes, errors, sent[0]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def serve_local(args):
+    """
+    --serve：在子进程中运行被测服务。就绪后在标准输出打印一行JSON（地址、工作目录），
+    标准输入收到一行后停止服务，再打印一行JSON报告本进程（服务端）的峰值RSS。
+    """
+    url, stop, workdir, service = start_local_server(args, args.broker_port)
+    # 等待MQTT客户端连接到替身
+    deadline = time.time() + 10
+    while not service.mqtt_outbox.connected and time.time() < deadline:
+        time.sleep(0.05)
+    print(json.dumps({'url': url, 'workdir': workdir}), flush=True)
+    sys.stdin.readline()
+    stop()
+    print(json.dumps({'peak_rss_mb': peak_rss_mb()}), flush=True)
+
+
+def start_server_process(args, broker_port):
+    """启动运行被测服务的子进程，返回 (地址, 停止函数, 工作目录)；停止函数返回服务端报告"""
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--broker-port', str(broker_port),
+               '--log-level', args.log_level] + (['--keep'] if args.keep else [])
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError(f'被测服务启动失败，退出码: {process.returncode}')
+    ready = json.loads(line)
+
+    def stop():
+        process.stdin.write('stop\n')
+        process.stdin.flush()
+        report = json.loads(process.stdout.readline() or '{}')
+        process.wait(timeout=60)
+        return report
+
+    return ready['url'], stop, ready['workdir']
+
+
+def peak_rss_mb():
+    """本进程的峰值常驻内存（MB），不支持的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='/upload 压测')
+    parser.add_argument('--url', help='压测已运行的服务，例如 http://127.0.0.1:5000；不指定则在子进程中启动')
+    parser.add_argument('--requests', type=int, default=100, help='请求总数（每个请求是一个批次）')
+    parser.add_argument('--concurrency', type=int, default=4, help='并发连接数')
+    parser.add_argument('--files-per-batch', type=int, default=5, help='每个批次的图片数')
+    parser.add_argument('--batches', type=int, default=5, help='每个项目的总批次数（final-only 模式忽略）')
+    parser.add_argument('--pattern', choices=BATCH_PATTERNS, default='sequential', help='批次发送模式')
+    parser.add_argument('--retry-rate', type=float, default=0.2, help='out-of-order 模式下重传的批次比例')
+    parser.add_argument('--image-size', default='1280x960', help='图片尺寸，宽x高')
+    parser.add_argument('--quality', type=int, default=85, help='JPEG质量')
+    parser.add_argument('--distinct-images', type=int, default=8, help='生成的不同图片数量，请求之间循环使用')
+    parser.add_argument('--upload-type', default='model', help='上传类型 model/craft')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子')
+    parser.add_argument('--keep', action='store_true', help='保留本地服务的临时工作目录')
+    parser.add_argument('--log-level', default='WARNING', help='本地服务的日志级别（INFO 时包含每个文件的日志开销）')
+    parser.add_argument('--output', help='结果JSON另存到该文件')
+    # 内部参数：子进程中运行被测服务
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--broker-port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_benchmark():
+    args = parse_args()
+    if args.serve:
+        serve_local(args)
+        return
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    images = [make_jpeg(width, height, args.quality, args.seed + i) for i in range(args.distinct_images)]
+    plan = plan_requests(args)
+
+    broker = None
+    stop = None
+    workdir = None
+    server_report = {}
+    url = args.url
+    if not url:
+        broker = FakeMqttBroker()
+        url, stop, workdir = start_server_process(args, broker.start())
+
+    try:
+        duration, latencies, status_codes, errors, sent_bytes = run_load(url, args, images, plan)
+    finally:
+        if stop:
+            server_report = stop()
+
+    latencies.sort()
+    result = {
+        'config': {
+            'url': args.url or 'local-process',
+            'requests': len(plan),
+            'concurrency': args.concurrency,
+            'files_per_batch': args.files_per_batch,
+            'batches': args.batches,
+            'pattern': args.pattern,
+            'retry_rate': args.retry_rate if args.pattern == 'out-of-order' else None,
+            'image_size': args.image_size,
+            'avg_image_bytes': round(statistics.mean(len(i) for i in images)),
+            'workdir': workdir if args.keep else None
+        },
+        'duration_s': round(duration, 3),
+        'completed': len(latencies),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'status_codes': {str(code): count for code, count in sorted(status_codes.items())},
+        'req_per_s': round(len(latencies) / duration, 2) if duration else None,
+        'mb_per_s': round(sent_bytes / duration / (1024 * 1024), 2) if duration else None,
+        'latency_ms': {
+            'mean': round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+            'p50': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            'p95': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'max': round(latencies[-1] * 1000, 2) if latencies else None
+        },
+        'peak_rss_mb': {'server': server_report.get('peak_rss_mb'), 'client': peak_rss_mb()},
+        'mqtt': {'messages': broker.messages, 'bytes': broker.bytes} if broker else None
+    }
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    run_benchmark()
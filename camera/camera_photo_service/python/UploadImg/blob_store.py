@@ -0,0 +1,105 @@
+import logging
+import os
+import uuid
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    按SHA-256内容寻址的去重存储。
+    每份内容只在 <root>/<hash前两位>/<hash> 保存一次，项目和轨迹目录下的文件是指向它的硬链接。
+    硬链接计数即引用计数：链接数为1的blob只被存储本身引用，可以被 cleanup 回收。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.hardlinks_supported = True
+        self.stats = {'stored': 0, 'dedup_hits': 0, 'bytes_saved': 0}
+        os.makedirs(root, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def store(self, tmp_path, digest, target_path):
+        """
+        将已写完的临时文件存入blob并在目标路径建立硬链接。
+        内容已存在时直接链接已有blob并丢弃临时文件，返回是否命中去重。
+        """
+        if not self.hardlinks_supported:
+            os.replace(tmp_path, target_path)
+            return False
+
+        blob = self.blob_path(digest)
+        size = os.path.getsize(tmp_path)
+        try:
+            self._link(blob, target_path)
+            os.remove(tmp_path)
+            self._count(dedup_hits=1, bytes_saved=size)
+            return True
+        except FileNotFoundError:
+            # blob不存在（或刚被回收），由本次上传的临时文件成为blob
+            pass
+        except OSError as e:
+            self._disable(e)
+            os.replace(tmp_path, target_path)
+            return False
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(tmp_path, blob)
+        try:
+            self._link(blob, target_path)
+        except OSError as e:
+            self._disable(e)
+            os.replace(blob, target_path)
+            return False
+        self._count(stored=1)
+        return False
+
+    def _link(self, blob, target_path):
+        """原子地让目标路径成为blob的硬链接（覆盖已存在的文件）"""
+        link_tmp = f'{target_path}.{uuid.uuid4().hex}.lnk'
+        os.link(blob, link_tmp)
+        try:
+            os.replace(link_tmp, target_path)
+        except OSError:
+            os.remove(link_tmp)
+            raise
+
+    def _disable(self, error):
+        """文件系统不支持硬链接时退回普通保存"""
+        if self.hardlinks_supported:
+            logger.warning(f"无法创建硬链接，去重存储已停用: {str(error)}")
+        self.hardlinks_supported = False
+
+    def _count(self, **deltas):
+        with self.lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, enabled=self.hardlinks_supported)
+
+    def cleanup(self):
+        """回收不再被任何项目文件引用的blob，返回 (回收数量, 回收字节数)"""
+        removed = 0
+        freed = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_nlink <= 1:
+                        os.remove(path)
+                        removed += 1
+                        freed += st.st_size
+                except FileNotFoundError:
+                    continue
+        logger.info(f"blob回收完成: {removed} 个, {freed} 字节")
+        return removed, freed
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from image_validation import parse_jpeg_header
+
+logger = logging.getLogger(__name__)
+
+# rel_path 为相对 uploaded_images 的路径，统一用 / 分隔：<类别>/<value>/<项目>[/tracks/<轨迹>]/<文件名>
+# 项目（及轨迹）列表查询按索引范围扫描并直接按 rel_path 有序返回，
+# 分页使用上一页最后一条的 rel_path 作为游标，不使用 OFFSET。
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    rel_path TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    value TEXT NOT NULL,
+    project TEXT NOT NULL,
+    track TEXT,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    width INTEGER,
+    height INTEGER,
+    capture_time TEXT,
+    batch_id TEXT,
+    batch_number INTEGER,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_project ON images (category, value, project, rel_path);
+CREATE INDEX IF NOT EXISTS idx_images_track ON images (category, value, project, track, rel_path);
+CREATE INDEX IF NOT EXISTS idx_images_sha256 ON images (sha256);
+CREATE INDEX IF NOT EXISTS idx_images_batch ON images (batch_id);
+'''
+
+COLUMNS = ('rel_path', 'category', 'value', 'project', 'track', 'filename', 'size', 'mtime_ns', 'sha256',
+           'width', 'height', 'capture_time', 'batch_id', 'batch_number', 'indexed_at')
+
+# App生成的文件名：<类型>_<序号>_<yyyyMMddHHmmss>.jpg
+CAPTURE_TIME_PATTERN = re.compile(r'_(\d{14})\.jpe?g$', re.IGNORECASE)
+
+
+def capture_time_from_name(filename):
+    """从App生成的文件名中解析拍摄时间（ISO格式），无法解析时返回 None"""
+    match = CAPTURE_TIME_PATTERN.search(filename)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), '%Y%m%d%H%M%S').isoformat()
+    except ValueError:
+        return None
+
+
+def describe_path(rel_path):
+    """
+    解析相对路径中的类别、value、项目和轨迹名，返回字典；
+    不符合 <类别>/<value>/<项目>/... 结构时返回 None。
+    """
+    parts = rel_path.split('/')
+    if len(parts) < 4:
+        return None
+    track = parts[4] if len(parts) >= 6 and parts[3] == 'tracks' else None
+    return {'category': parts[0], 'value': parts[1], 'project': parts[2], 'track': track, 'filename': parts[-1]}
+
+
+class ImageIndex:
+    """
+    已上传图片的元数据索引（SQLite），上传落盘时写入，查询不再遍历目录。
+    索引与磁盘不一致时（手动复制或删除文件、启用索引前的历史文件）用 rebuild() 从磁盘重建。
+    """
+
+    def __init__(self, db_path, root):
+        self.db_path = db_path
+        self.root = root
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def rel_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def make_record(self, path, sha256=None, width=None, height=None, batch_id=None, batch_number=None):
+        """根据磁盘文件生成一条索引记录，路径结构不符时返回 None"""
+        rel_path = self.rel_path(path)
+        info = describe_path(rel_path)
+        if info is None:
+            return None
+        st = os.stat(path)
+        return dict(info, rel_path=rel_path, size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=sha256,
+                    width=width, height=height, capture_time=capture_time_from_name(info['filename']),
+                    batch_id=batch_id, batch_number=batch_number, indexed_at=time.time())
+
+    def add_many(self, records):
+        """在一个事务中写入多条记录，同一路径的旧记录被替换"""
+        records = [r for r in records if r]
+        if not records:
+            return
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._insert(conn, records)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _insert(self, conn, records):
+        conn.executemany(
+            f'INSERT OR REPLACE INTO images ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})',
+            [tuple(r[c] for c in COLUMNS) for r in records]
+        )
+
+    def query(self, category=None, value=None, project=None, track=None, batch_id=None, batch_number=None,
+              sha256=None, cursor=None, limit=100):
+        """
+        按条件查询，结果按 rel_path 排序。
+        返回 (记录列表, 下一页游标)，没有下一页时游标为 None。
+        """
+        conditions = []
+        params = []
+        for column, param in (('category', category), ('value', value), ('project', project),
+                              ('track', track), ('batch_id', batch_id), ('batch_number', batch_number),
+                              ('sha256', sha256)):
+            if param is not None:
+                conditions.append(f'{column} = ?')
+                params.append(param)
+        if cursor:
+            conditions.append('rel_path > ?')
+            params.append(cursor)
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self._connect() as conn:
+            rows = conn.execute(f'SELECT * FROM images {where} ORDER BY rel_path LIMIT ?',
+                                params + [limit + 1]).fetchall()
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = items[-1]['rel_path'] if len(rows) > limit else None
+        return items, next_cursor
+
+    def summary(self, category, value, project):
+        """项目的图片数、总字节数和轨迹列表"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM images '
+                'WHERE category = ? AND value = ? AND project = ?',
+                (category, value, project)
+            ).fetchone()
+            tracks = [r[0] for r in conn.execute(
+                'SELECT DISTINCT track FROM images WHERE category = ? AND value = ? AND project = ? '
+                'AND track IS NOT NULL ORDER BY track',
+                (category, value, project)
+            )]
+        return {'files': row['files'], 'bytes': row['bytes'], 'tracks': tracks}
+
+    def rebuild(self, extensions=('jpg', 'jpeg')):
+        """
+        从磁盘重建索引。大小和修改时间未变的文件沿用原有的哈希和批次信息，不重新计算；
+        以 . 开头的内部目录（.sessions、.blobs、.thumbs）不计入。
+        """
+        start = time.perf_counter()
+        with self._connect() as conn:
+            existing = {row['rel_path']: dict(row) for row in conn.execute('SELECT * FROM images')}
+
+        records = []
+        hashed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.rsplit('.', 1)[-1].lower() not in extensions:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    record = self.make_record(path)
+                    if record is None:
+                        continue
+                    old = existing.get(record['rel_path'])
+                    if old and (old['size'], old['mtime_ns']) == (record['size'], record['mtime_ns']):
+                        for column in ('sha256', 'width', 'height', 'batch_id', 'batch_number'):
+                            record[column] = old[column]
+                    else:
+                        record['sha256'] = self._hash(path)
+                        hashed += 1
+                        try:
+                            record['width'], record['height'] = parse_jpeg_header(path)
+                        except ValueError:
+                            pass
+                    records.append(record)
+                except OSError as e:
+                    logger.error(f"索引文件失败 {path}: {str(e)}")
+
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM images')
+                self._insert(conn, records)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        elapsed = time.perf_counter() - start
+        logger.info(f"图片索引已重建: {len(records)} 个文件，重新计算哈希 {hashed} 个，耗时 {elapsed:.1f} 秒")
+        return len(records)
+
+    @staticmethod
+    def _hash(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
@@ -0,0 +1,116 @@
+import struct
+import time
+from threading import Lock
+
+# 校验级别，由快到慢：
+#   marker  只检查JPEG起止标记并解析帧头（SOF）得到尺寸
+#   verify  Pillow verify，检查文件结构但不解码像素（原有行为）
+#   decode  完整解码像素数据
+VALIDATION_LEVELS = ('marker', 'verify', 'decode')
+
+# SOF帧头标记（排除DHT=C4、JPG=C8、DAC=CC）
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# 无长度字段的独立标记：TEM 和 RST0-RST7
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+SOS_MARKER = 0xDA
+
+
+def parse_jpeg_header(path):
+    """逐段跳读JPEG头部直到SOF，返回 (宽, 高)，结构不合法时抛出 ValueError"""
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError('不是有效的JPEG文件（缺少SOI标记）')
+        while True:
+            byte = f.read(1)
+            if not byte:
+                raise ValueError('JPEG头部不完整（未找到SOF）')
+            if byte != b'\xff':
+                raise ValueError('JPEG段标记无效')
+            # 跳过填充的0xFF
+            marker = f.read(1)
+            while marker == b'\xff':
+                marker = f.read(1)
+            if not marker:
+                raise ValueError('JPEG头部不完整（未找到SOF）')
+            code = marker[0]
+            if code in STANDALONE_MARKERS:
+                continue
+            if code == SOS_MARKER:
+                raise ValueError('JPEG缺少SOF帧头')
+
+            length_bytes = f.read(2)
+            if len(length_bytes) != 2:
+                raise ValueError('JPEG段长度不完整')
+            length = struct.unpack('>H', length_bytes)[0]
+            if length < 2:
+                raise ValueError('JPEG段长度无效')
+
+            if code in SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) != 5:
+                    raise ValueError('JPEG帧头不完整')
+                height, width = struct.unpack('>HH', frame[1:5])
+                if not width or not height:
+                    raise ValueError('JPEG尺寸无效')
+                return width, height
+            f.seek(length - 2, 1)
+
+
+def validate_image(path, level):
+    """按指定级别校验磁盘上的图片，返回 (宽, 高)，校验失败抛出 ValueError"""
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(f'未知的校验级别: {level}')
+    if level == 'marker':
+        return parse_jpeg_header(path)
+    # Pillow 在首次需要时才导入，marker 级别和服务启动都不加载
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            size = image.size
+            if level == 'verify':
+                image.verify()
+            else:
+                image.load()
+            return size
+    except Exception as e:
+        raise ValueError(f'图片校验失败: {str(e)}') from e
+
+
+class ValidationStats:
+    """按校验级别统计次数、失败数和耗时"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats = {level: {'count': 0, 'failures': 0, 'total_seconds': 0.0} for level in VALIDATION_LEVELS}
+
+    def timed_validate(self, path, level):
+        """校验并记录耗时"""
+        if level not in VALIDATION_LEVELS:
+            raise ValueError(f'未知的校验级别: {level}')
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = validate_image(path, level)
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                entry = self.stats[level]
+                entry['count'] += 1
+                entry['total_seconds'] += elapsed
+                if not ok:
+                    entry['failures'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                level: {
+                    'count': entry['count'],
+                    'failures': entry['failures'],
+                    'total_ms': round(entry['total_seconds'] * 1000, 3),
+                    'avg_ms': round(entry['total_seconds'] * 1000 / entry['count'], 3) if entry['count'] else 0
+                }
+                for level, entry in self.stats.items()
+            }
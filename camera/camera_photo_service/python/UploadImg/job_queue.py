@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 任务状态：
+#   queued   等待执行（包括等待重试）
+#   running  正在执行
+#   waiting  PLY尚未生成，已交给目录监听等待
+#   done     已完成
+#   failed   重试次数用尽
+# owner 为领取任务的进程（主机名:PID），执行中和等待中的任务在 lease_expires_at 之前归该进程所有，
+# 进程存活期间定期续租；租约过期说明进程已退出或失去响应，任务由其他进程重新排队。
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    next_run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    result TEXT,
+    stages TEXT NOT NULL DEFAULT '{}',
+    owner TEXT,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (state, next_run_at);
+'''
+
+
+class JobQueue:
+    """
+    基于SQLite的持久化任务队列，多个线程或进程可以同时从中领取任务。
+    每次操作使用独立连接，领取任务在 BEGIN IMMEDIATE 事务中完成，保证同一任务只被领取一次。
+    领取的任务带 lease 秒的租约，由 renew() 续租；只有租约过期的任务才会被 recover() 重新排队，
+    状态更新只对本进程持有的任务生效，租约过期后被其他进程接手的任务不会被原进程覆盖。
+    """
+
+    def __init__(self, db_path, max_attempts=3, retry_delay=10, lease=60):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, task_id, kind, payload):
+        """加入队列，同一 task_id 重复加入时忽略，返回是否新加入"""
+        now = time.time()
+        with self._connect() as conn:
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO jobs (task_id, kind, payload, state, max_attempts, next_run_at, '
+                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (task_id, kind, json.dumps(payload, ensure_ascii=False), 'queued', self.max_attempts, now, now, now)
+            ).rowcount == 1
+        if inserted:
+            logger.info(f"任务已入队 - TaskID: {task_id}, 类型: {kind}")
+        return inserted
+
+    def claim(self):
+        """领取一个到期的排队任务并标记为执行中，没有任务时返回 None"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE state = 'queued' AND next_run_at <= ? "
+                    "ORDER BY next_run_at, created_at LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, owner = ?, lease_expires_at = ?, "
+                    "updated_at = ? WHERE task_id = ?",
+                    (self.owner, now + self.lease, now, row['task_id'])
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        job = self._to_dict(row)
+        job['attempts'] += 1
+        job['state'] = 'running'
+        job['owner'] = self.owner
+        return job
+
+    def record_stage(self, task_id, stage, started, seconds):
+        """记录任务某个阶段的开始时间和耗时"""
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT stages FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            if row is not None:
+                stages = json.loads(row['stages'])
+                stages[stage] = {'started': started, 'seconds': round(seconds, 6)}
+                conn.execute('UPDATE jobs SET stages = ? WHERE task_id = ?', (json.dumps(stages), task_id))
+            conn.execute('COMMIT')
+
+    def set_state(self, task_id, state, result=None):
+        """更新本进程持有的任务的状态（waiting / done），返回是否更新"""
+        with self._connect() as conn:
+            updated = conn.execute(
+                'UPDATE jobs SET state = ?, result = COALESCE(?, result), updated_at = ? '
+                'WHERE task_id = ? AND owner = ?',
+                (state, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 time.time(), task_id, self.owner)
+            ).rowcount == 1
+        if not updated:
+            logger.warning(f"任务已不归本进程所有，忽略状态更新 - TaskID: {task_id}, 状态: {state}")
+        return updated
+
+    def resume(self, task_id, payload):
+        """
+        本进程中等待PLY的任务在文件就绪后重新排队，由任务线程执行，返回是否成功。
+        payload 替换原有参数；等待不算一次执行，已用的执行次数减一。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET state = 'queued', payload = ?, attempts = MAX(attempts - 1, 0), next_run_at = ?, "
+                "lease_expires_at = NULL, updated_at = ? WHERE task_id = ? AND state = 'waiting' AND owner = ?",
+                (json.dumps(payload, ensure_ascii=False), now, now, task_id, self.owner)
+            ).rowcount == 1
+
+    def fail(self, task_id, error):
+        """
+        记录执行失败：未达到最大次数时按指数退避重新排队，返回是否还会重试。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT attempts, max_attempts FROM jobs WHERE task_id = ? AND owner = ?',
+                               (task_id, self.owner)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return False
+            retry = row['attempts'] < row['max_attempts']
+            if retry:
+                delay = self.retry_delay * 2 ** (row['attempts'] - 1)
+                conn.execute(
+                    "UPDATE jobs SET state = 'queued', next_run_at = ?, error = ?, updated_at = ? WHERE task_id = ?",
+                    (now + delay, error, now, task_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET state = 'failed', error = ?, updated_at = ? WHERE task_id = ?",
+                    (error, now, task_id)
+                )
+            conn.execute('COMMIT')
+        return retry
+
+    def renew(self):
+        """延长本进程持有的执行中和等待中任务的租约，返回数量"""
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE owner = ? AND state IN ('running', 'waiting')",
+                (now + self.lease, self.owner)
+            ).rowcount
+
+    def recover(self):
+        """
+        租约已过期（持有的进程已退出或失去响应）的执行中、等待中任务重新排队，返回数量。
+        其他存活进程持有的任务不受影响。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            count = conn.execute(
+                "UPDATE jobs SET state = 'queued', next_run_at = ?, lease_expires_at = NULL, updated_at = ? "
+                "WHERE state IN ('running', 'waiting') AND (lease_expires_at IS NULL OR lease_expires_at <= ?)",
+                (now, now, now)
+            ).rowcount
+        if count:
+            logger.info(f"恢复租约过期的任务: {count} 个")
+        return count
+
+    def get(self, task_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def counts(self):
+        """各状态的任务数量"""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state').fetchall()
+        return {row['state']: row['n'] for row in rows}
+
+    def _to_dict(self, row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['stages'] = json.loads(job['stages'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
@@ -1,223 +1,1054 @@
-import asyncio
-import base64
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, Request, Response, request, jsonify, send_file, make_response
 import os
 from datetime import datetime
 import logging
-import zipfile
 import json
-from gmqtt import Client as MQTTClient
 import glob
 from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from waitress import serve
+from threading import Lock, BoundedSemaphore
 import uuid
-from PIL import Image
-import io
+import tempfile
+import argparse
+import hashlib
+import shutil
+import time
+import sys
+import atexit
+import subprocess
+import socket
 import multiprocessing
-from threading import Thread
-
-# 配置日志记录
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+from urllib.parse import quote
+from contextlib import contextmanager
+from threading import Thread, Event
+from upload_sessions import UploadSessionStore, SessionError, missing_ranges
+from batch_store import BatchStore
+from blob_store import BlobStore
+from image_validation import ValidationStats
+from ply_transfer import ChunkedTransferManager
+from archive_cache import PlyArchiveCache
+from ply_watcher import PlyWatcher
+from job_queue import JobQueue
+from mqtt_outbox import MqttOutbox
+from metrics import MetricsRegistry, SharedMetrics
+from thumbnails import ThumbnailCache
+from image_index import ImageIndex
+from result_store import PlyResultStore
+from tracing import Tracer
+
 logger = logging.getLogger(__name__)
 
-# Flask应用配置
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 限制上传大小为100MB
+
+def configure_logging():
+    """配置日志记录"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler('app.log')
+        ]
+    )
+
+
+def temp_file_stream_factory(total_content_length, content_type, filename=None, content_length=None):
+    """multipart文件部分一律落到临时文件，避免小文件批量上传时整体驻留内存"""
+    return tempfile.TemporaryFile('wb+')
+
+
+class StreamingRequest(Request):
+    """使用临时文件接收multipart文件部分的请求类"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return temp_file_stream_factory(total_content_length, content_type, filename, content_length)
+
+
+# 路由注册在蓝图上，由 create_app() 创建Flask应用
+bp = Blueprint('upload', __name__)
+MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 限制上传大小为100MB
 UPLOAD_FOLDER = 'uploaded_images'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg'}
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+MQTT_CLIENT_ID = "python-server"  # MQTT客户端ID，--worker 进程在后面加上 -<worker-id>，避免与服务进程互相挤下线
 MQTT_TOPIC = "ply/files"
 PLY_CHECK_PATH = r"C:\Users\ElonSnyder\Desktop\code\Test"  # PLY文件检查路径
+PLY_TRANSFER_MODE = 'inline'  # inline: 整个压缩包base64放在一条消息中; chunked: 分块发送; reference: 消息中只给出下载地址
+MQTT_CHUNK_TOPIC = "ply/files/chunks"  # 分块传输的数据主题
+MQTT_RESEND_TOPIC = "ply/files/resend"  # 订阅端请求重传缺失分块的主题
+MQTT_CHUNK_SIZE = 256 * 1024  # 每条分块消息的原始数据大小
+PLY_TRANSFER_FOLDER = 'ply_transfers'  # 分块传输期间保留压缩包的目录
+PLY_TRANSFER_TTL = 3600  # 压缩包保留时间（秒），过期后不再响应重传
+PLY_RESULT_FOLDER = 'ply_results'  # reference 模式下按内容哈希保存压缩包的目录
+PLY_RESULT_TTL = 7 * 24 * 3600  # reference 模式下压缩包的保留时间（秒）
+PLY_PUBLIC_BASE_URL = ''  # 订阅端访问本服务的地址，例如 http://192.168.1.10:5000；为空时消息中只给出路径
+PLY_COMPACTION = False  # 打包前将ASCII点云转为二进制并可选降采样（需要numpy）
+PLY_VOXEL_SIZE = 0.0  # 体素降采样的边长，0表示不降采样
+PLY_COMPACT_FOLDER = 'ply_compacted'  # 压缩后PLY文件的临时目录
+PLY_COMPRESS_LEVEL = 6  # PLY压缩包的zlib压缩级别（1-9），越大越慢、压缩率越高
+PLY_COMPRESS_WORKERS = os.cpu_count()  # 并行压缩PLY文件的进程数，1表示在任务线程中依次压缩
+PLY_STORE_RATIO = 0.9  # 试压缩后大小/原始大小不低于该值的文件不压缩（STORED），如二进制点云
+PLY_SAMPLE_SIZE = 256 * 1024  # 判断是否值得压缩时从文件首、中、尾各取的字节数
+PLY_ARCHIVE_CACHE = True  # 是否缓存已构建的PLY压缩包（输入文件不变时跳过压缩）
+PLY_ARCHIVE_CACHE_FOLDER = 'ply_archive_cache'  # 压缩包缓存目录
+PLY_ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 缓存总大小上限，超出按LRU淘汰
+PLY_WATCH = True  # 最后批次到达时PLY尚未生成完，则由后台监听等待而不是立即返回失败
+PLY_WAIT_TIMEOUT = 30 * 60  # 等待PLY生成的最长时间（秒）
+PLY_STABLE_SECONDS = 3  # PLY文件大小保持不变多少秒视为写完
+JOB_DB_PATH = 'jobs.db'  # PLY打包发送任务队列的SQLite文件
+JOB_WORKERS = 1  # 服务进程内处理任务的线程数，0表示只由 --worker 进程处理
+JOB_MAX_ATTEMPTS = 3  # 任务最多执行次数
+JOB_RETRY_DELAY = 10  # 首次重试的等待秒数，之后按指数增加
+JOB_POLL_INTERVAL = 1.0  # 任务线程空闲时检查队列的间隔（秒）
+JOB_LEASE_SECONDS = 60  # 任务租约时长（秒），持有任务的进程每隔三分之一租约续租一次，进程退出后租约到期才会被重新执行
+MQTT_OUTBOX_SPILL_PATH = os.path.join('mqtt_outbox', 'spill.jsonl')  # 内存队列满或退出时未发送消息的保存位置
+MQTT_OUTBOX_MAX_MEMORY_BYTES = 64 * 1024 * 1024  # 发件箱内存队列的字节上限，超出后写入磁盘
+MQTT_OUTBOX_MAX_DISK_BYTES = 1024 * 1024 * 1024  # 溢出文件上限，超出后丢弃新消息
+BATCH_DB_PATH = 'batches.db'  # 各项目已收到批次数的SQLite文件，多个HTTP工作进程共享
+BATCH_TTL = 24 * 3600  # 项目超过该时间（秒）未收到新批次则丢弃其批次记录
+BATCH_REPLAY_WINDOW = 10 * 60  # 项目收齐后该时间（秒）内再次收到的批次视为重传，不再触发PLY处理
+BATCH_MAX_PROJECTS = 10000  # 同时跟踪批次进度的项目数上限，超出时淘汰最早过期的项目
+MAX_TOTAL_BATCHES = 10000  # 单个项目的总批次数上限
+FINAL_BATCH_STATUS_CODE = 202  # 最后批次入队后的HTTP状态码；旧版App只认200时可改为200
+STREAM_CHUNK_SIZE = 64 * 1024  # 流式写盘的块大小
+MAX_FILE_SIZE = MAX_CONTENT_LENGTH  # 单个文件大小上限
+JPEG_SOI = b'\xff\xd8'  # JPEG起始标记
+JPEG_EOI = b'\xff\xd9'  # JPEG结束标记
+SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, '.sessions')  # 断点续传会话目录
+SESSION_TTL = 24 * 3600  # 断点续传会话有效期（秒）
+MAX_CHUNK_SIZE = 16 * 1024 * 1024  # 断点续传单个分片大小上限
+RECOMMENDED_CHUNK_SIZE = 1024 * 1024  # 建议客户端使用的分片大小
+DEDUP_STORAGE = False  # 是否启用按内容哈希去重的存储（项目文件为指向blob的硬链接）
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, '.blobs')  # 去重存储的blob目录
+THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, '.thumbs')  # 缩略图缓存目录
+THUMBNAIL_SIZE = 256  # 缩略图最长边（像素）
+THUMBNAIL_QUALITY = 80  # 缩略图JPEG质量
+THUMBNAIL_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 缩略图缓存总大小上限，超出按最近访问时间淘汰
+THUMBNAIL_ON_INGEST = False  # 文件落盘后立即在线程池中生成缩略图；否则在首次请求时生成
+THUMBNAIL_MAX_AGE = 24 * 3600  # 缩略图响应的 Cache-Control max-age（秒）
+IMAGE_INDEX_DB_PATH = 'images.db'  # 已上传图片元数据索引的SQLite文件
+IMAGE_QUERY_LIMIT = 100  # /images 每页默认条数
+IMAGE_QUERY_MAX_LIMIT = 1000  # /images 每页最多条数
+DOWNLOAD_MAX_AGE = 3600  # /files 下载响应的 Cache-Control max-age（秒），之后客户端用 ETag/Last-Modified 重新验证
+EXPORT_PAGE_SIZE = 500  # 项目导出时每次从图片索引读取的条数
+# 由前端HTTP服务器（Apache mod_xsendfile、lighttpd）直接发送文件：响应只带 X-Sendfile 头，不经过Python
+DOWNLOAD_USE_X_SENDFILE = False
+# 各上传类型的图片校验级别：marker（仅标记和帧头）、verify（Pillow verify）、decode（完整解码）
+VALIDATION_LEVELS = {
+    'model': 'verify',
+    'craft': 'verify'
+}
+
+MAX_PENDING_FILES = os.cpu_count() * 8  # 线程池中排队+处理中的文件数上限
+UPLOAD_QUEUE_TIMEOUT = 30  # 等待排队名额的秒数，超时则拒绝该文件，0表示立即拒绝
+PROCESSES = 1  # HTTP工作进程数，大于1时各进程共享同一个监听套接字（仅waitress模式）
+PROCESS_RESTART_DELAY = 1.0  # 工作进程退出后重新启动前等待的秒数
+METRICS_SHARE_FOLDER = 'metrics'  # 多进程模式下各进程写入指标快照的目录，/metrics 和 /status 据此汇总所有进程
+METRICS_SHARE_INTERVAL = 5.0  # 写入指标快照的间隔（秒）
+TRACE_BUFFER_SIZE = 10000  # 进程内保留的最近跟踪记录（span）数，供 /traces 查询
+TRACE_LOG_PATH = 'traces.jsonl'  # 每个span追加一行JSON的文件，多个进程共用；为空时只保存在内存中
+TRACE_LOG_MAX_BYTES = 16 * 1024 * 1024  # 跟踪日志超过该大小时轮转
+TRACE_LOG_BACKUPS = 3  # 保留的已轮转跟踪日志数（traces.jsonl.1 … .3）
 
-# 创建线程池
-executor = ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() * 2)
 processing_lock = Lock()
-mqtt_client = None
+job_wakeup = Event()
+
+# /metrics 指标（Prometheus 文本格式）
+metrics = MetricsRegistry(prefix='uploadimg_')
+upload_stage_seconds = metrics.histogram(
+    'upload_stage_seconds', '上传各阶段耗时（秒）：parse、write、validate、place、total', ['stage'])
+ply_stage_seconds = metrics.histogram(
+    'ply_stage_seconds', 'PLY处理各阶段耗时（秒）：discovery、archive、encode、publish、total', ['stage'])
+bytes_in_total = metrics.counter('bytes_in_total', '收到的请求体字节数', ['source'])
+bytes_out_total = metrics.counter('bytes_out_total', '发出的消息字节数', ['sink'])
+upload_files_total = metrics.counter('upload_files_total', '按处理结果统计的上传文件数', ['status'])
+inflight_requests = metrics.gauge('inflight_requests', '正在处理的HTTP请求数')
 
-# 确保上传目录存在
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# 按 task_id 记录上传和PLY处理各阶段的span，文件在写入第一个span时才打开
+tracer = Tracer(TRACE_BUFFER_SIZE, TRACE_LOG_PATH or None, max_bytes=TRACE_LOG_MAX_BYTES,
+                backups=TRACE_LOG_BACKUPS)
+
+# 以下对象由 init_services() 创建，导入模块时不创建目录、线程池等
+executor = None
+ingest_slots = None
+session_store = None
+thumbnail_cache = None
+image_index = None
+ply_results = None
+compress_pool = None  # PLY压缩进程池，首次打包时创建
+compress_pool_lock = Lock()
+batch_store = None
+blob_store = None
+validation_stats = None
+chunked_transfers = None
+archive_cache = None
+ply_watcher = None
+job_queue = None
+mqtt_outbox = None
+mqtt_client_id = MQTT_CLIENT_ID
+shared_metrics = None  # 多进程模式下由 run_prefork 和 serve_http_process 创建
+
+
+def init_services(background=True, instance=None):
+    """
+    创建线程池、存储目录和后台组件，重复调用时不再创建。
+    background 为假时（多进程模式下的HTTP工作进程）不创建PLY处理和MQTT相关组件，
+    这些由主进程负责，工作进程只把任务写入共享的任务队列。
+    instance 非空时（--worker 进程）MQTT客户端ID、发件箱溢出文件、分块传输目录和压缩包缓存目录
+    都带上实例名，与同时运行的服务进程互不干扰。
+    """
+    global executor, ingest_slots, session_store, batch_store, blob_store, validation_stats, thumbnail_cache
+    global image_index, ply_results
+    global chunked_transfers, archive_cache, ply_watcher, job_queue, mqtt_outbox, mqtt_client_id
+    if executor is not None:
+        return
+
+    # 创建线程池
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count() * 2)
+    ingest_slots = BoundedSemaphore(MAX_PENDING_FILES)
+    # 依赖组件的指标只在创建了该组件的进程中注册
+    metrics.gauge('executor_queue_depth', '线程池中等待执行的任务数', lambda: executor._work_queue.qsize())
+    metrics.gauge('ingest_slots_free', '剩余的文件排队名额', lambda: ingest_slots._value)
+
+    # 确保上传目录存在
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    session_store = UploadSessionStore(SESSION_FOLDER, ttl=SESSION_TTL)
+    batch_store = BatchStore(BATCH_DB_PATH, ttl=BATCH_TTL, replay_window=BATCH_REPLAY_WINDOW,
+                             max_projects=BATCH_MAX_PROJECTS)
+    blob_store = BlobStore(BLOB_FOLDER) if DEDUP_STORAGE else None
+    image_index = ImageIndex(IMAGE_INDEX_DB_PATH, UPLOAD_FOLDER)
+    ply_results = PlyResultStore(PLY_RESULT_FOLDER, ttl=PLY_RESULT_TTL)
+    thumbnail_cache = ThumbnailCache(THUMBNAIL_FOLDER, UPLOAD_FOLDER, THUMBNAIL_CACHE_MAX_BYTES,
+                                     size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY)
+    validation_stats = ValidationStats()
+    job_queue = JobQueue(JOB_DB_PATH, max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY,
+                         lease=JOB_LEASE_SECONDS)
+    if not background:
+        return
+
+    suffix = f'_{instance}' if instance else ''
+    mqtt_client_id = f'{MQTT_CLIENT_ID}-{instance}' if instance else MQTT_CLIENT_ID
+    chunked_transfers = ChunkedTransferManager(
+        PLY_TRANSFER_FOLDER + suffix,
+        lambda message, topic=None: send_mqtt_message(message, topic or MQTT_TOPIC, wait=True),
+        chunk_size=MQTT_CHUNK_SIZE,
+        ttl=PLY_TRANSFER_TTL,
+        chunk_topic=MQTT_CHUNK_TOPIC,
+        resend_topic=MQTT_RESEND_TOPIC
+    )
+    archive_cache = (PlyArchiveCache(PLY_ARCHIVE_CACHE_FOLDER + suffix, PLY_ARCHIVE_CACHE_MAX_BYTES)
+                     if PLY_ARCHIVE_CACHE else None)
+    ply_watcher = PlyWatcher(
+        PLY_CHECK_PATH,
+        on_ready=lambda task: resume_waiting_task(task),
+        on_timeout=lambda task: timeout_waiting_task(task),
+        stable_seconds=PLY_STABLE_SECONDS
+    )
+    spill_root, spill_ext = os.path.splitext(MQTT_OUTBOX_SPILL_PATH)
+    mqtt_outbox = MqttOutbox(spill_root + suffix + spill_ext, max_memory_bytes=MQTT_OUTBOX_MAX_MEMORY_BYTES,
+                             max_disk_bytes=MQTT_OUTBOX_MAX_DISK_BYTES)
+    metrics.gauge('mqtt_outbox_depth', 'MQTT发件箱中待发送的消息数', lambda: mqtt_outbox.snapshot()['queue_depth'])
+
+
+def create_app(background=True):
+    """创建Flask应用"""
+    configure_logging()
+    init_services(background)
+    app = Flask(__name__)
+    app.request_class = StreamingRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    app.config['USE_X_SENDFILE'] = DOWNLOAD_USE_X_SENDFILE
+    app.register_blueprint(bp)
+    return app
+
+
+def send_no_ply_files(task_id, project_name, message='未找到PLY文件，生成失败'):
+    """通知客户端没有可用的PLY文件"""
+    send_mqtt_message({
+        'type': 'no_ply_files',
+        'task_id': task_id,
+        'message': message,
+        'project_name': project_name,
+        'timestamp': datetime.now().isoformat()
+    })
 
 
-def check_and_process_ply_files(task_id, project_name=None):
-    """检查和处理PLY文件"""
+def ply_stage(task_id):
+    """返回把PLY处理阶段耗时记录到 /metrics 并作为任务span记录的上下文管理器"""
+    @contextmanager
+    def stage(name):
+        with ply_stage_seconds.time(name), tracer.span(task_id, name) as span:
+            yield span
+    return stage
+
+
+@contextmanager
+def upload_stage(task_id, name, **attrs):
+    """把上传阶段耗时记录到 /metrics 并作为任务span记录，attrs 为span的附加字段"""
+    with upload_stage_seconds.time(name), tracer.span(task_id, name, **attrs) as span:
+        yield span
+
+
+def check_and_process_ply_files(task_id, project_name=None, wait=True, stage=None):
+    """检查和处理PLY文件，出错时发送错误消息并返回 False"""
     try:
-        ply_files = glob.glob(os.path.join(PLY_CHECK_PATH, "*.ply"))
+        with ply_stage_seconds.time('total'):
+            return process_ply_files(task_id, project_name, wait, stage)
+    except Exception as e:
+        logger.error(f"处理PLY文件失败: {str(e)}")
+        send_ply_error(task_id, project_name, e)
+        return False
+
+
+def send_ply_error(task_id, project_name, error):
+    """通知客户端PLY处理出错"""
+    send_mqtt_message({
+        'type': 'error',
+        'task_id': task_id,
+        'error': str(error),
+        'project_name': project_name,
+        'timestamp': datetime.now().isoformat()
+    })
 
-        if not ply_files:
-            logger.info(f"未找到PLY文件 - TaskID: {task_id}")
+
+def process_ply_files(task_id, project_name=None, wait=True, stage=None, on_wait=None):
+    """
+    查找、打包并发送PLY文件，异常向上抛出由调用方决定是否重试。
+    wait 为真且PLY监听已启动时，如果PLY还没生成或仍在写入，登记为等待任务并返回 None，
+    文件就绪后由监听线程再次处理（wait=False）。
+    on_wait() 在登记之前调用：任务队列据此先把任务标记为 waiting，登记后文件立即就绪时也能重新排队。
+    stage(name) 是记录各阶段耗时的上下文管理器，返回可补充字节数的span，默认为 ply_stage(task_id)。
+    """
+    stage = stage or ply_stage(task_id)
+    with stage('discovery') as span:
+        if wait and ply_watcher.running and not ply_watcher.files_ready():
+            if on_wait:
+                on_wait()
+            ply_watcher.wait_for(task_id, project_name, PLY_WAIT_TIMEOUT)
             send_mqtt_message({
-                'type': 'no_ply_files',
+                'type': 'ply_pending',
                 'task_id': task_id,
-                'message': '未找到PLY文件，生成失败',
+                'message': 'PLY文件尚未生成，生成后自动发送',
                 'project_name': project_name,
                 'timestamp': datetime.now().isoformat()
             })
-            return False
+            return None
 
-        # 创建ZIP文件
-        zip_path = os.path.join(PLY_CHECK_PATH, f"ply_files_{task_id}.zip")
-        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-            for ply_file in ply_files:
-                zipf.write(ply_file, os.path.basename(ply_file))
+        ply_files = glob.glob(os.path.join(PLY_CHECK_PATH, "*.ply"))
+        span['files'] = len(ply_files)
+        span['bytes'] = sum(os.path.getsize(path) for path in ply_files)
 
-        # 读取并发送ZIP文件
-        with open(zip_path, 'rb') as file:
-            zip_data = file.read()
-            zip_base64 = base64.b64encode(zip_data).decode('utf-8')
+    if not ply_files:
+        logger.info(f"未找到PLY文件 - TaskID: {task_id}")
+        send_no_ply_files(task_id, project_name)
+        return False
+
+    with stage('archive') as span:
+        zip_path, point_counts, cached = build_ply_archive(ply_files, task_id)
+        span['bytes'] = os.path.getsize(zip_path)
+        span['cached'] = cached
+    file_name = f"ply_files_{task_id}.zip"
 
+    # 分块模式：逐块读取发送，压缩包保留一段时间以便重传
+    if PLY_TRANSFER_MODE == 'chunked':
+        with stage('publish') as span:
+            span['bytes'] = os.path.getsize(zip_path)
+            chunked_transfers.start(zip_path, task_id, project_name, extra={'point_counts': point_counts},
+                                    file_name=file_name, move=not cached)
+        return True
+
+    # 引用模式：压缩包按内容哈希保存，消息中只有文件信息和下载地址，订阅端需要时再通过HTTP下载
+    if PLY_TRANSFER_MODE == 'reference':
+        with stage('encode') as span:
+            sha256, size = ply_results.put(zip_path, move=not cached)
+            span['bytes'] = size
             message = {
-                'type': 'ply_files',
+                'type': 'ply_files_ref',
                 'task_id': task_id,
-                'fileName': os.path.basename(zip_path),
-                'fileData': zip_base64,
+                'fileName': file_name,
+                'size': size,
+                'sha256': sha256,
+                'url': f"{PLY_PUBLIC_BASE_URL.rstrip('/')}/ply/{sha256}.zip?name={quote(file_name)}",
+                'point_counts': point_counts,
                 'project_name': project_name,
                 'timestamp': datetime.now().isoformat()
             }
+        with stage('publish') as span:
+            span['bytes'] = len(json.dumps(message))
             send_mqtt_message(message)
-
-        # 清理ZIP文件
-        os.remove(zip_path)
         return True
 
-    except Exception as e:
-        logger.error(f"处理PLY文件失败: {str(e)}")
-        send_mqtt_message({
-            'type': 'error',
+    # 读取并发送ZIP文件
+    with stage('encode') as span:
+        import base64
+
+        with open(zip_path, 'rb') as file:
+            zip_data = file.read()
+            zip_base64 = base64.b64encode(zip_data).decode('utf-8')
+        span['bytes'] = len(zip_base64)
+
+        message = {
+            'type': 'ply_files',
             'task_id': task_id,
-            'error': str(e),
+            'fileName': file_name,
+            'fileData': zip_base64,
+            'point_counts': point_counts,
             'project_name': project_name,
             'timestamp': datetime.now().isoformat()
-        })
-        return False
+        }
+    with stage('publish') as span:
+        span['bytes'] = len(zip_base64)
+        send_mqtt_message(message)
+
+    # 清理ZIP文件（缓存中的压缩包保留）
+    if not cached:
+        os.remove(zip_path)
+    return True
 
 
-def send_mqtt_message(message):
-    """发送MQTT消息"""
+def enqueue_ply_job(task_id, project_name):
+    """项目批次收齐后把PLY打包发送加入持久化队列"""
+    if job_queue.enqueue(task_id, 'ply', {'project_name': project_name}):
+        job_wakeup.set()
+
+
+def check_batch_numbers(batch_number, total_batches):
+    """检查批次号范围，无效时抛出 ValueError"""
+    if not 1 <= total_batches <= MAX_TOTAL_BATCHES:
+        raise ValueError(f'总批次数无效: {total_batches}')
+    if not 1 <= batch_number <= total_batches:
+        raise ValueError(f'批次号无效: {batch_number}/{total_batches}')
+
+
+def record_batch(project_key, project_name, batch_number, total_batches, saved_files, task_id):
+    """
+    记录项目收到一个批次，返回批次进度（见 BatchStore.add_batch）。
+    项目收齐时以收齐时的任务ID把PLY处理加入队列；收齐后重传的批次得到同一个任务ID，
+    再次入队会被忽略，上次收齐后未能入队时由重传补上。
+    """
+    progress = batch_store.add_batch(project_key, project_name, batch_number, total_batches, saved_files, task_id)
+    if progress['complete']:
+        enqueue_ply_job(progress['task_id'], project_name)
+    return progress
+
+
+def batch_expiry_loop():
+    """在最早的过期时间到达时清理过期的项目批次记录"""
+    while True:
+        try:
+            next_expiry = batch_store.next_expiry()
+            delay = BATCH_TTL if next_expiry is None else next_expiry - time.time()
+            if delay <= 0:
+                batch_store.expire()
+                continue
+        except Exception as e:
+            logger.error(f"清理过期项目批次记录失败: {str(e)}")
+            delay = JOB_POLL_INTERVAL
+        # 其他进程新增的记录最早在 BATCH_REPLAY_WINDOW 秒后过期，睡眠不超过这个时间
+        time.sleep(min(delay, BATCH_REPLAY_WINDOW))
+
+
+def job_stage(task_id):
+    """返回把阶段耗时写入任务队列（同时记录到 /metrics 和任务span）的上下文管理器"""
+    @contextmanager
+    def stage(name):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            with tracer.span(task_id, name) as span:
+                yield span
+        finally:
+            elapsed = time.perf_counter() - start
+            ply_stage_seconds.observe(elapsed, name)
+            job_queue.record_stage(task_id, name, started, elapsed)
+    return stage
+
+
+def run_ply_job(job):
+    """执行一个PLY任务，失败时抛出异常"""
+    task_id = job['task_id']
+    project_name = job['payload'].get('project_name')
+    logger.info(f"开始执行任务 - TaskID: {task_id}, 第 {job['attempts']} 次")
+    with ply_stage_seconds.time('total'):
+        found = process_ply_files(task_id, project_name, wait=job['payload'].get('wait', True),
+                                  stage=job_stage(task_id),
+                                  on_wait=lambda: job_queue.set_state(task_id, 'waiting'))
+    # 登记等待的任务已标记为 waiting，此时可能已被监听线程重新排队，不能再改状态
+    if found is not None:
+        job_queue.set_state(task_id, 'done', {'ply_files_found': found})
+
+
+def job_worker_loop():
+    """任务线程：从队列领取任务执行，失败按退避重试，次数用尽后通知客户端"""
+    while True:
+        job = job_queue.claim()
+        if job is None:
+            job_wakeup.wait(JOB_POLL_INTERVAL)
+            job_wakeup.clear()
+            continue
+        try:
+            run_ply_job(job)
+        except Exception as e:
+            retry = job_queue.fail(job['task_id'], str(e))
+            logger.error(f"任务执行失败 - TaskID: {job['task_id']}, 将重试: {retry}, 错误: {str(e)}")
+            if not retry:
+                send_ply_error(job['task_id'], job['payload'].get('project_name'), e)
+
+
+def job_lease_loop():
+    """定期续租本进程持有的任务，并把租约过期（持有进程已退出）的任务重新排队"""
+    while True:
+        time.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            job_queue.renew()
+            if job_queue.recover():
+                job_wakeup.set()
+        except Exception as e:
+            logger.error(f"任务续租失败: {str(e)}")
+
+
+def start_job_workers(count):
+    """恢复租约过期的任务，启动续租线程和任务线程"""
+    job_queue.recover()
+    Thread(target=job_lease_loop, daemon=True, name='job-lease').start()
+    for i in range(count):
+        Thread(target=job_worker_loop, daemon=True, name=f'job-worker-{i}').start()
+
+
+def resume_waiting_task(task):
+    """
+    PLY文件就绪后把等待中的任务重新放回队列，由任务线程按正常流程执行，
+    失败时同样按退避重试、次数用尽后标记为 failed。
+    """
+    if job_queue.resume(task['task_id'], {'project_name': task['project_name'], 'wait': False}):
+        job_wakeup.set()
+
+
+def timeout_waiting_task(task):
+    """等待PLY文件超时"""
+    send_no_ply_files(task['task_id'], task['project_name'], '等待PLY文件生成超时')
+    job_queue.set_state(task['task_id'], 'done', {'ply_files_found': False, 'timeout': True})
+
+
+def task_trace(task_id):
+    """
+    任务从上传到PLY发布的全部span（按开始时间排序）及总耗时。
+    最后一个批次的任务ID同时是PLY任务的ID，其跟踪记录包含上传和PLY处理两部分。
+    """
+    spans = tracer.get(task_id)
+    if not spans:
+        return {'code': 404, 'message': '没有该任务的跟踪记录'}, 404
+    return {
+        'code': 200,
+        'task_id': task_id,
+        'seconds': round(max(span['end'] for span in spans) - spans[0]['start'], 6),
+        'bytes': sum(span['bytes'] for span in spans),
+        'spans': spans
+    }, 200
+
+
+def recent_traces(args):
+    """
+    本进程跟踪缓冲区中各任务的概况，参数：min_seconds（只返回总耗时不低于该值的任务）、limit。
+    多进程模式下只包含处理该请求的进程记录的span，按任务ID查询时会读取共用的跟踪日志。
+    """
     try:
-        if mqtt_client and mqtt_client.is_connected:
-            mqtt_client.publish(
-                MQTT_TOPIC,
-                json.dumps(message),
-                qos=1,  # 使用QoS 1确保消息至少被接收一次
-                retain=False
-            )
-            logger.info(f"已发送MQTT消息: {message['type']}")
-            return True
-        else:
-            logger.error("MQTT客户端未连接")
-            return False
+        min_seconds = float(args.get('min_seconds', 0))
+        limit = int(args.get('limit', 50))
+        if limit <= 0:
+            raise ValueError(limit)
+    except ValueError:
+        return {'code': 400, 'message': '参数无效'}, 400
+    tasks = tracer.tasks(min_seconds, limit)
+    return {'code': 200, 'count': len(tasks), 'tasks': tasks}, 200
+
+
+def task_status(task_id):
+    """查询任务状态和各阶段耗时"""
+    job = job_queue.get(task_id)
+    if not job:
+        return {'code': 404, 'message': '任务不存在'}, 404
+    return {
+        'code': 200,
+        'task_id': task_id,
+        'state': job['state'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'error': job['error'],
+        'result': job['result'],
+        'stages': job['stages'],
+        'project_name': job['payload'].get('project_name'),
+        'created_at': datetime.fromtimestamp(job['created_at']).isoformat(),
+        'updated_at': datetime.fromtimestamp(job['updated_at']).isoformat()
+    }, 200
+
+
+def build_ply_archive(ply_files, task_id):
+    """
+    构建PLY压缩包，返回 (压缩包路径, 点数统计, 是否位于缓存中)。
+    输入文件和打包参数与之前某次相同时直接复用缓存中的压缩包。
+    """
+    cache_key = None
+    if archive_cache:
+        settings = {'compaction': PLY_COMPACTION, 'voxel_size': PLY_VOXEL_SIZE, 'level': PLY_COMPRESS_LEVEL,
+                    'store_ratio': PLY_STORE_RATIO}
+        cache_key = archive_cache.fingerprint(ply_files, settings)
+        hit = archive_cache.get(cache_key)
+        if hit:
+            logger.info(f"PLY压缩包缓存命中 - TaskID: {task_id}")
+            return hit[0], hit[1].get('point_counts'), True
+
+    # 打包前压缩点云，记录处理前后的点数
+    point_counts = None
+    staging_dir = None
+    if PLY_COMPACTION:
+        ply_files, point_counts, staging_dir = compact_ply_files(ply_files, task_id)
+
+    # 各文件在进程池中并行压缩，不值得压缩的文件原样存储
+    import ply_archive
+
+    zip_path = os.path.join(PLY_CHECK_PATH, f"ply_files_{task_id}.zip")
+    try:
+        stats = ply_archive.build_zip(ply_files, zip_path, level=PLY_COMPRESS_LEVEL, sample_size=PLY_SAMPLE_SIZE,
+                                      store_ratio=PLY_STORE_RATIO, pool=get_compress_pool())
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    logger.info(f"PLY打包完成 - TaskID: {task_id}, 文件: {stats['files']} "
+                f"(DEFLATE {stats['deflated']} / STORED {stats['stored']}), "
+                f"{stats['bytes_in']} -> {stats['bytes_out']} 字节, 压缩比: {stats['ratio']}, "
+                f"级别: {stats['level']}, 耗时: {stats['seconds']} 秒")
+
+    if cache_key:
+        cached_path = archive_cache.put(cache_key, zip_path, {'point_counts': point_counts})
+        if cached_path:
+            return cached_path, point_counts, True
+    return zip_path, point_counts, False
+
+
+def get_compress_pool():
+    """PLY压缩进程池，PLY_COMPRESS_WORKERS 不大于1时返回 None（在当前线程压缩）"""
+    global compress_pool
+    if PLY_COMPRESS_WORKERS <= 1:
+        return None
+    with compress_pool_lock:
+        if compress_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn 启动的进程不继承任务线程、MQTT事件循环等状态，各平台行为一致
+            compress_pool = ProcessPoolExecutor(max_workers=PLY_COMPRESS_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return compress_pool
+
+
+def compact_ply_files(ply_files, task_id):
+    """
+    逐个压缩PLY文件，返回 (用于打包的文件列表, 点数统计, 临时目录)。
+    点数统计包含每个文件和合计的处理前后点数。
+    """
+    import ply_tools
+
+    staging_dir = os.path.join(PLY_COMPACT_FOLDER, task_id)
+    os.makedirs(staging_dir, exist_ok=True)
+    output_files = []
+    files_stats = []
+    for ply_file in ply_files:
+        try:
+            output, stats = ply_tools.compact_ply(ply_file, staging_dir, PLY_VOXEL_SIZE)
+        except Exception as e:
+            # 单个文件解析失败时原样打包，不影响整体发送
+            logger.error(f"PLY压缩失败，原样发送 {ply_file}: {str(e)}")
+            output, stats = ply_file, {'file': os.path.basename(ply_file), 'points_before': None,
+                                       'points_after': None, 'compacted': False}
+        output_files.append(output)
+        files_stats.append(stats)
+
+    counted = [s for s in files_stats if s['points_before'] is not None]
+    point_counts = {
+        'before': sum(s['points_before'] for s in counted),
+        'after': sum(s['points_after'] for s in counted),
+        'voxel_size': PLY_VOXEL_SIZE,
+        'files': files_stats
+    }
+    logger.info(f"PLY压缩 - TaskID: {task_id}, 点数 {point_counts['before']} -> {point_counts['after']}")
+    return output_files, point_counts, staging_dir
+
+
+def send_mqtt_message(message, topic=MQTT_TOPIC, wait=False):
+    """
+    发送MQTT消息：放入发件箱后返回，由MQTT事件循环中的发送协程发布，未连接时消息保留到重连后发送。
+    wait 为真时发件箱内存队列满则等待腾出空间，连续发送大量消息时避免积压占满内存。
+    """
+    try:
+        payload = json.dumps(message)
+        queued = mqtt_outbox.put(topic, payload, qos=1, wait=wait)  # 使用QoS 1确保消息至少被接收一次
+        if queued:
+            bytes_out_total.inc('mqtt', amount=len(payload))
+            logger.info(f"已加入MQTT发件箱: {message['type']}")
+        return queued
     except Exception as e:
         logger.error(f"发送MQTT消息失败: {str(e)}")
         return False
 
 
-@app.route('/upload', methods=['POST'])
-async def upload_image():
-    """处理文件上传请求"""
+def resolve_save_path(project_dir, file_info, filename):
+    """根据文件信息确定保存路径（轨迹文件保存到 tracks/<trackName> 下）"""
+    name = os.path.basename(file_info.get('relativePath', filename))
+    if file_info.get('type') == 'track':
+        track_dir = os.path.join(project_dir, 'tracks', file_info.get('trackName', 'unknown_track'))
+        os.makedirs(track_dir, exist_ok=True)
+        return os.path.join(track_dir, name)
+    return os.path.join(project_dir, name)
+
+
+def validation_level(upload_type):
+    """上传类型对应的校验级别"""
+    return VALIDATION_LEVELS['model' if upload_type == 'model' else 'craft']
+
+
+def check_jpeg_markers(path, level):
+    """
+    检查磁盘上文件的JPEG起止标记。
+    EOI只在 marker 级别要求位于文件末尾：部分相机和编辑软件会在EOI之后追加数据，
+    verify/decode 级别由 Pillow 判断文件是否完整。
+    """
+    with open(path, 'rb') as f:
+        head = f.read(2)
+        f.seek(-2, os.SEEK_END)
+        tail = f.read(2)
+    if head != JPEG_SOI:
+        raise ValueError('不是有效的JPEG文件（缺少SOI标记）')
+    if level == 'marker' and tail != JPEG_EOI:
+        raise ValueError('JPEG文件不完整（缺少EOI标记）')
+
+
+def place_file(tmp_path, save_path, digest):
+    """将校验通过的临时文件放到目标路径，启用去重时存入blob并建立硬链接"""
+    if blob_store:
+        return blob_store.store(tmp_path, digest, save_path)
+    os.replace(tmp_path, save_path)
+    return False
+
+
+def hash_file(path):
+    """计算磁盘文件的SHA-256"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def stream_file_to_disk(file, save_path, level, task_id=None):
+    """
+    将上传文件分块写入目标目录下的临时文件，边写边校验、边计算SHA-256，
+    按 level 校验通过后原子重命名到目标路径。
+    返回 (写入的字节数, SHA-256, (宽, 高))，空文件返回 (0, None, None)，校验失败抛出 ValueError。
+    各阶段作为 task_id 的span记录。
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix='.part')
+    name = os.path.basename(save_path)
+    size = 0
+    tail = b''
+    sha256 = hashlib.sha256()
     try:
-        task_id = str(uuid.uuid4())
-        logger.info(f"收到上传请求 - TaskID: {task_id}")
+        with upload_stage(task_id, 'write', file=name) as span, os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = file.stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # 首块检查JPEG起始标记
+                if size == 0 and not chunk.startswith(JPEG_SOI):
+                    raise ValueError('不是有效的JPEG文件（缺少SOI标记）')
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise ValueError(f'文件超过大小限制 {MAX_FILE_SIZE} 字节')
+                tail = (tail + chunk)[-2:]
+                sha256.update(chunk)
+                f.write(chunk)
+                span['bytes'] = size
 
-        # 获取基本信息
-        try:
-            batch_number = int(request.form.get('batch_number', '1'))
-            total_batches = int(request.form.get('total_batches', '1'))
-        except ValueError as e:
-            logger.error(f"批次信息无效: {str(e)}")
-            return jsonify({
-                'code': 400,
-                'message': '批次信息无效'
-            }), 400
-
-        upload_type = request.form.get('type', '')
-        upload_value = request.form.get('value', '')
-        project_info = json.loads(request.form.get('project_info', '{}'))
-
-        logger.info(f"批次: {batch_number}/{total_batches}")
-        logger.info(f"上传类型: {upload_type}")
-        logger.info(f"上传值: {upload_value}")
-
-        # 创建保存目录结构
-        category_folder = '模型' if upload_type == 'model' else '工艺'
-        base_save_path = os.path.join(UPLOAD_FOLDER, category_folder, upload_value)
-        project_dir = os.path.join(base_save_path, project_info.get('name', 'unknown_project'))
-
-        os.makedirs(base_save_path, exist_ok=True)
-        os.makedirs(project_dir, exist_ok=True)
-
-        # 处理上传的文件
-        saved_files = []
-        files = request.files.getlist('files[]')
-
-        if not files:
-            return jsonify({
-                'code': 400,
-                'message': '没有接收到文件'
-            }), 400
-
-        for i, file in enumerate(files):
-            try:
-                file_content = file.read()
-                if not file_content:
-                    continue
-
-                # 验证图片文件
-                try:
-                    image = Image.open(io.BytesIO(file_content))
-                    image.verify()
-                except Exception as e:
-                    logger.error(f"无效的图片文件 {file.filename}: {str(e)}")
-                    continue
-
-                # 获取文件信息
-                file_info = json.loads(request.form.get(f'file_info_{i}', '{}'))
-
-                # 确定保存路径
-                if file_info.get('type') == 'track':
-                    track_dir = os.path.join(project_dir, 'tracks', file_info.get('trackName', 'unknown_track'))
-                    os.makedirs(track_dir, exist_ok=True)
-                    save_path = os.path.join(track_dir, os.path.basename(file_info.get('relativePath', file.filename)))
-                else:
-                    save_path = os.path.join(project_dir,
-                                             os.path.basename(file_info.get('relativePath', file.filename)))
-
-                # 保存文件
-                with open(save_path, 'wb') as f:
-                    f.write(file_content)
-
-                saved_files.append(save_path)
-
-            except Exception as e:
-                logger.error(f"处理文件失败 {file.filename}: {str(e)}")
-                continue
+        if size == 0:
+            os.remove(tmp_path)
+            return 0, None, None
+        # EOI之后允许有追加数据，verify/decode 级别由 Pillow 判断是否完整（见 check_jpeg_markers）
+        if level == 'marker' and tail != JPEG_EOI:
+            raise ValueError('JPEG文件不完整（缺少EOI标记）')
 
-        # 如果是最后一个批次，检查PLY文件
-        if batch_number == total_batches:
-            has_ply = check_and_process_ply_files(task_id, project_info.get('name'))
-            return jsonify({
-                'code': 200,
-                'message': '所有批次上传完成',
-                'task_id': task_id,
-                'saved_files': len(saved_files),
-                'ply_files_found': has_ply
-            })
+        with upload_stage(task_id, 'validate', file=name, bytes=size):
+            dimensions = validation_stats.timed_validate(tmp_path, level)
+        digest = sha256.hexdigest()
+        with upload_stage(task_id, 'place', file=name, bytes=size):
+            place_file(tmp_path, save_path, digest)
+        return size, digest, dimensions
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def ingest_file(file, save_path, level, task_id=None):
+    """在线程池中执行：写盘并校验单个文件，返回处理结果"""
+    result = {'file': file.filename}
+    try:
+        written, digest, dimensions = stream_file_to_disk(file, save_path, level, task_id)
+        if written:
+            result.update(status='saved', size=written, sha256=digest, path=save_path,
+                          width=dimensions[0], height=dimensions[1])
+            if THUMBNAIL_ON_INGEST:
+                executor.submit(pregenerate_thumbnail, save_path)
         else:
-            return jsonify({
-                'code': 200,
-                'message': f'批次 {batch_number}/{total_batches} 上传成功',
-                'task_id': task_id,
-                'saved_files': len(saved_files)
-            })
+            result['status'] = 'empty'
+    except ValueError as e:
+        logger.error(f"无效的图片文件 {file.filename}: {str(e)}")
+        result.update(status='invalid', message=str(e))
+    except Exception as e:
+        logger.error(f"处理文件失败 {file.filename}: {str(e)}")
+        result.update(status='error', message=str(e))
+    return result
+
+
+def pregenerate_thumbnail(save_path):
+    """在线程池中为刚落盘的图片生成缩略图"""
+    try:
+        thumbnail_cache.get(os.path.relpath(save_path, UPLOAD_FOLDER))
+    except Exception as e:
+        logger.error(f"生成缩略图失败 {save_path}: {str(e)}")
+
+
+def submit_ingest(file, save_path, level, wait=True, task_id=None):
+    """
+    提交文件到线程池处理。排队名额用尽时最多等待 UPLOAD_QUEUE_TIMEOUT 秒，
+    仍无名额返回 None，由调用方拒绝该文件，避免无限堆积。
+    """
+    if not ingest_slots.acquire(timeout=UPLOAD_QUEUE_TIMEOUT if wait else 0):
+        return None
+    return _submit_acquired(file, save_path, level, task_id)
+
+
+async def submit_ingest_async(file, save_path, level, wait=True, task_id=None):
+    """submit_ingest 的异步版本，等待名额时让出事件循环而不是阻塞线程"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (UPLOAD_QUEUE_TIMEOUT if wait else 0)
+    while not ingest_slots.acquire(blocking=False):
+        if loop.time() >= deadline:
+            return None
+        await asyncio.sleep(0.05)
+    return _submit_acquired(file, save_path, level, task_id)
+
+
+def _submit_acquired(file, save_path, level, task_id):
+    """已取得排队名额后提交任务，任务结束时归还名额"""
+    try:
+        future = executor.submit(ingest_file, file, save_path, level, task_id)
+    except Exception:
+        ingest_slots.release()
+        raise
+    future.add_done_callback(lambda _: ingest_slots.release())
+    return future
+
+
+def category_folder(upload_type):
+    """上传类型对应的类别目录名"""
+    return '模型' if upload_type == 'model' else '工艺'
+
+
+def make_project_dir(upload_type, upload_value, project_info):
+    """创建并返回项目保存目录：uploaded_images/<模型|工艺>/<value>/<project>"""
+    base_save_path = os.path.join(UPLOAD_FOLDER, category_folder(upload_type), upload_value)
+    project_dir = os.path.join(base_save_path, project_info.get('name', 'unknown_project'))
+
+    os.makedirs(base_save_path, exist_ok=True)
+    os.makedirs(project_dir, exist_ok=True)
+    return project_dir
+
+
+def prepare_upload(form, files, task_id):
+    """
+    解析上传表单并规划每个文件的保存路径。
+    返回 (上下文, None)；参数错误时返回 (None, (响应体, 状态码))。
+    """
+    logger.info(f"收到上传请求 - TaskID: {task_id}")
+
+    # 获取基本信息
+    try:
+        batch_number = int(form.get('batch_number', '1'))
+        total_batches = int(form.get('total_batches', '1'))
+        check_batch_numbers(batch_number, total_batches)
+    except ValueError as e:
+        logger.error(f"批次信息无效: {str(e)}")
+        return None, ({
+            'code': 400,
+            'message': '批次信息无效'
+        }, 400)
+
+    upload_type = form.get('type', '')
+    upload_value = form.get('value', '')
+    project_info = json.loads(form.get('project_info', '{}'))
+
+    logger.info(f"批次: {batch_number}/{total_batches}")
+    logger.info(f"上传类型: {upload_type}")
+    logger.info(f"上传值: {upload_value}")
+
+    project_dir = make_project_dir(upload_type, upload_value, project_info)
+
+    if not files:
+        return None, ({
+            'code': 400,
+            'message': '没有接收到文件'
+        }, 400)
+
+    # 确定每个文件的保存路径，失败的文件直接记为错误结果
+    jobs = []
+    for i, file in enumerate(files):
+        try:
+            file_info = json.loads(form.get(f'file_info_{i}', '{}'))
+            jobs.append((file, resolve_save_path(project_dir, file_info, file.filename)))
+        except Exception as e:
+            logger.error(f"处理文件失败 {file.filename}: {str(e)}")
+            jobs.append((file, {'file': file.filename, 'status': 'error', 'message': str(e)}))
+
+    return {
+        'task_id': task_id,
+        'batch_number': batch_number,
+        'total_batches': total_batches,
+        'project_name': project_info.get('name'),
+        'project_key': os.path.relpath(project_dir, UPLOAD_FOLDER),
+        'validation_level': validation_level(upload_type),
+        'jobs': jobs
+    }, None
+
+
+def index_saved_files(results, batch_id, batch_number):
+    """把本批次落盘的文件写入图片索引（一个事务），索引失败不影响上传结果"""
+    try:
+        image_index.add_many([
+            image_index.make_record(r['path'], r['sha256'], r['width'], r['height'], batch_id, batch_number)
+            for r in results
+        ])
+    except Exception as e:
+        logger.error(f"写入图片索引失败 - 批次: {batch_id}: {str(e)}")
+
+
+def finish_upload(ctx, file_results):
+    """根据文件处理结果生成响应，最后一个批次时检查PLY文件"""
+    task_id = ctx['task_id']
+    batch_number = ctx['batch_number']
+    total_batches = ctx['total_batches']
+
+    saved_files = [r['path'] for r in file_results if r['status'] == 'saved']
+    rejected = sum(1 for r in file_results if r['status'] == 'rejected')
+    for r in file_results:
+        upload_files_total.inc(r['status'])
+    index_saved_files([r for r in file_results if r['status'] == 'saved'], task_id, batch_number)
+
+    # 有文件因队列已满被拒绝时返回503，客户端稍后重传本批次
+    if rejected:
+        return {
+            'code': 503,
+            'message': f'服务器繁忙，{rejected} 个文件未处理，请稍后重试',
+            'task_id': task_id,
+            'saved_files': len(saved_files),
+            'files': file_results
+        }, 503
+
+    # 项目的所有批次都已收到（各批次可以乱序到达、由不同工作进程接收），PLY打包发送加入队列后立即返回
+    progress = record_batch(ctx['project_key'], ctx['project_name'], batch_number, total_batches,
+                            len(saved_files), task_id)
+    if progress['complete']:
+        ply_task_id = progress['task_id']
+        return {
+            'code': FINAL_BATCH_STATUS_CODE,
+            'message': '所有批次上传完成，PLY处理已排队',
+            'task_id': ply_task_id,
+            'received_batches': progress['received'],
+            'saved_files': len(saved_files),
+            'files': file_results,
+            'status_url': f'/tasks/{ply_task_id}'
+        }, FINAL_BATCH_STATUS_CODE
+
+    payload = {
+        'code': 200,
+        'message': f'批次 {batch_number}/{total_batches} 上传成功',
+        'task_id': task_id,
+        'received_batches': progress['received'],
+        'saved_files': len(saved_files),
+        'files': file_results
+    }
+    if 'missing' in progress:
+        payload['missing_batches'] = progress['missing']
+    return payload, 200
+
+
+def rejected_result(file):
+    """队列已满时被拒绝文件的处理结果"""
+    logger.warning(f"处理队列已满，拒绝文件: {file.filename}")
+    return {'file': file.filename, 'status': 'rejected'}
+
+
+def process_upload(form, files, task_id):
+    """同步处理一次上传（Flask/waitress 模式），返回 (响应体, 状态码)"""
+    ctx, error = prepare_upload(form, files, task_id)
+    if error:
+        return error
 
+    # 并行写盘校验，整批耗时取决于最慢的文件
+    pending = []
+    queue_full = False
+    for file, target in ctx['jobs']:
+        if isinstance(target, dict):
+            pending.append(target)
+            continue
+        # 一旦有文件被拒绝，本批次剩余文件不再等待名额
+        future = submit_ingest(file, target, ctx['validation_level'], wait=not queue_full, task_id=ctx['task_id'])
+        queue_full = queue_full or future is None
+        pending.append(future if future is not None else rejected_result(file))
+
+    file_results = [p if isinstance(p, dict) else p.result() for p in pending]
+    return finish_upload(ctx, file_results)
+
+
+async def process_upload_async(form, files, task_id):
+    """异步处理一次上传（ASGI 模式），等待文件处理期间不占用线程"""
+    import asyncio
+
+    # 创建项目目录等文件操作放到默认线程池
+    loop = asyncio.get_running_loop()
+    ctx, error = await loop.run_in_executor(None, prepare_upload, form, files, task_id)
+    if error:
+        return error
+
+    pending = []
+    queue_full = False
+    for file, target in ctx['jobs']:
+        if isinstance(target, dict):
+            pending.append(target)
+            continue
+        future = await submit_ingest_async(file, target, ctx['validation_level'], wait=not queue_full,
+                                           task_id=ctx['task_id'])
+        queue_full = queue_full or future is None
+        pending.append(future if future is not None else rejected_result(file))
+
+    file_results = [p if isinstance(p, dict) else await asyncio.wrap_future(p) for p in pending]
+
+    # PLY打包等阻塞操作放到线程池，不阻塞事件循环
+    return await loop.run_in_executor(executor, finish_upload, ctx, file_results)
+
+
+@bp.route('/upload', methods=['POST'])
+def upload_image():
+    """处理文件上传请求"""
+    task_id = str(uuid.uuid4())
+    try:
+        with upload_stage_seconds.time('total'):
+            # 访问 form/files 时才解析multipart请求体
+            with upload_stage(task_id, 'parse', bytes=request.content_length or 0):
+                form = request.form
+                files = request.files.getlist('files[]')
+            bytes_in_total.inc('upload', amount=request.content_length or 0)
+            payload, code = process_upload(form, files, task_id)
+        return jsonify(payload), code
     except Exception as e:
         logger.error(f"上传处理错误: {str(e)}")
         return jsonify({
@@ -226,45 +1057,959 @@ async def upload_image():
         }), 500
 
 
+def load_json_field(params, name):
+    """读取可能以JSON字符串形式提交的字段"""
+    value = params.get(name) or {}
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def session_view(session):
+    """会话信息的对外表示"""
+    return {
+        'session_id': session['session_id'],
+        'size': session['size'],
+        'received': session['received'],
+        'missing': missing_ranges(session['received'], session['size']),
+        'received_bytes': sum(end - start for start, end in session['received']),
+        'chunk_size': RECOMMENDED_CHUNK_SIZE
+    }
+
+
+def create_upload_session(params):
+    """
+    创建断点续传会话。参数与 /upload 的表单字段一致（type、value、project_info、
+    file_info、batch_number、total_batches），另需 filename 和 size；
+    last_in_batch 为真表示这是本批次的最后一个文件：它和同批次其他会话都落盘后记为收到一个批次，
+    项目的批次收齐时检查PLY文件。
+    """
+    try:
+        size = int(params.get('size', 0))
+        batch_number = int(params.get('batch_number', 1))
+        total_batches = int(params.get('total_batches', 1))
+        check_batch_numbers(batch_number, total_batches)
+        filename = params.get('filename', '')
+        if not filename:
+            raise ValueError('缺少文件名')
+        if size > MAX_FILE_SIZE:
+            return {'code': 413, 'message': f'文件超过大小限制 {MAX_FILE_SIZE} 字节'}, 413
+        metadata = {
+            'filename': filename,
+            'type': params.get('type', ''),
+            'value': params.get('value', ''),
+            'project_info': load_json_field(params, 'project_info'),
+            'file_info': load_json_field(params, 'file_info'),
+            'batch_number': batch_number,
+            'total_batches': total_batches,
+            'last_in_batch': str(params.get('last_in_batch', '')).lower() in ('1', 'true')
+        }
+        project_key = os.path.join(category_folder(metadata['type']), metadata['value'],
+                                   metadata['project_info'].get('name', 'unknown_project'))
+        session = session_store.create(size, metadata, batch_key=f'{project_key}#{batch_number}',
+                                       closes_batch=metadata['last_in_batch'])
+    except (ValueError, TypeError) as e:
+        return {'code': 400, 'message': f'会话参数无效: {str(e)}'}, 400
+    except SessionError as e:
+        return {'code': e.code, 'message': str(e)}, e.code
+    return {'code': 200, 'message': '上传会话已创建', **session_view(session)}, 200
+
+
+def get_upload_session(session_id):
+    """查询断点续传会话已接收的字节区间"""
+    try:
+        session = session_store.get(session_id)
+    except SessionError as e:
+        return {'code': e.code, 'message': str(e)}, e.code
+    return {'code': 200, 'complete': session_store.is_complete(session), **session_view(session)}, 200
+
+
+def write_upload_chunk(session_id, offset, chunks):
+    """写入一个分片，全部字节到齐后校验并落盘到项目目录"""
+    try:
+        session = session_store.write_chunk(session_id, offset, chunks, max_length=MAX_CHUNK_SIZE)
+        claimed = session_store.claim_completed(session_id)
+    except SessionError as e:
+        return {'code': e.code, 'message': str(e)}, e.code
+
+    if not claimed:
+        return {'code': 200, 'complete': False, **session_view(session)}, 200
+    return finalize_upload_session(claimed)
+
+
+def finalize_upload_session(session):
+    """校验已完整接收的文件，原子移动到项目目录，必要时触发PLY检查"""
+    session_id = session['session_id']
+    metadata = session['metadata']
+    part_path = session_store.part_path(session_id)
+    try:
+        level = validation_level(metadata['type'])
+        check_jpeg_markers(part_path, level)
+        width, height = validation_stats.timed_validate(part_path, level)
+        project_dir = make_project_dir(metadata['type'], metadata['value'], metadata['project_info'])
+        save_path = resolve_save_path(project_dir, metadata['file_info'], metadata['filename'])
+        digest = hash_file(part_path)
+        place_file(part_path, save_path, digest)
+    except ValueError as e:
+        logger.error(f"无效的图片文件 {metadata['filename']}: {str(e)}")
+        session_store.remove(session_id)
+        return {'code': 422, 'message': f'文件校验失败，请重新上传: {str(e)}', 'session_id': session_id}, 422
+    except Exception as e:
+        # 磁盘已满、权限等错误：释放领取，分片文件保留，客户端稍后重发分片时再次落盘
+        logger.error(f"断点续传落盘失败 {metadata['filename']}: {str(e)}")
+        session_store.release(session_id)
+        return {'code': 500, 'message': f'文件落盘失败，请稍后重试: {str(e)}', 'session_id': session_id}, 500
+    records_batch = session_store.complete(session_id)
+    logger.info(f"断点续传完成: {save_path}")
+
+    payload = {
+        'code': 200,
+        'message': '文件上传完成',
+        'session_id': session_id,
+        'complete': True,
+        'file': {
+            'file': metadata['filename'],
+            'status': 'saved',
+            'size': session['size'],
+            'sha256': digest,
+            'path': save_path,
+            'width': width,
+            'height': height
+        }
+    }
+    index_saved_files([payload['file']], session_id, metadata['batch_number'])
+    if records_batch:
+        # 批次的文件全部落盘后记一个批次，项目的批次收齐后触发PLY处理，与 /upload 的最后批次一样返回 FINAL_BATCH_STATUS_CODE
+        project_name = metadata['project_info'].get('name')
+        progress = record_batch(os.path.relpath(project_dir, UPLOAD_FOLDER), project_name,
+                                metadata['batch_number'], metadata['total_batches'], 1, str(uuid.uuid4()))
+        payload['received_batches'] = progress['received']
+        if progress['complete']:
+            payload['code'] = FINAL_BATCH_STATUS_CODE
+            payload['message'] = '所有批次上传完成，PLY处理已排队'
+            payload['task_id'] = progress['task_id']
+            payload['status_url'] = f"/tasks/{progress['task_id']}"
+        elif 'missing' in progress:
+            payload['missing_batches'] = progress['missing']
+    return payload, payload['code']
+
+
+def abort_upload_session(session_id):
+    """放弃断点续传会话"""
+    try:
+        session_store.get(session_id)
+    except SessionError as e:
+        return {'code': e.code, 'message': str(e)}, e.code
+    session_store.remove(session_id)
+    return {'code': 200, 'message': '上传会话已删除', 'session_id': session_id}, 200
+
+
+def read_request_stream(stream):
+    """按块读取请求体"""
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+@bp.route('/upload/sessions', methods=['POST'])
+def create_session_route():
+    """创建断点续传会话"""
+    payload, code = create_upload_session(request.get_json(silent=True) or request.form)
+    return jsonify(payload), code
+
+
+@bp.route('/upload/sessions/<session_id>', methods=['GET'])
+def get_session_route(session_id):
+    """查询断点续传会话状态"""
+    payload, code = get_upload_session(session_id)
+    return jsonify(payload), code
+
+
+@bp.route('/upload/sessions/<session_id>', methods=['PUT', 'PATCH'])
+def write_chunk_route(session_id):
+    """写入分片，偏移量由查询参数 offset 指定，请求体为分片原始字节"""
+    try:
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        return jsonify({'code': 400, 'message': '分片偏移无效'}), 400
+    payload, code = write_upload_chunk(session_id, offset, read_request_stream(request.stream))
+    bytes_in_total.inc('session', amount=request.content_length or 0)
+    return jsonify(payload), code
+
+
+@bp.route('/upload/sessions/<session_id>', methods=['DELETE'])
+def abort_session_route(session_id):
+    """放弃断点续传会话"""
+    payload, code = abort_upload_session(session_id)
+    return jsonify(payload), code
+
+
+def on_mqtt_message(client, topic, payload, qos, properties):
+    """处理订阅消息：订阅端请求重传缺失的分块"""
+    if topic == MQTT_RESEND_TOPIC:
+        try:
+            request_data = json.loads(payload)
+            executor.submit(chunked_transfers.resend, request_data['transfer_id'], request_data.get('missing', []))
+        except Exception as e:
+            logger.error(f"重传请求无效: {str(e)}")
+    return 0
+
+
 async def setup_mqtt():
     """设置MQTT客户端"""
-    client = MQTTClient("python-server")
+    from gmqtt import Client as MQTTClient
+
+    client = MQTTClient(mqtt_client_id)
+    client.on_message = on_mqtt_message
     await client.connect(MQTT_BROKER, MQTT_PORT)
+    client.subscribe(MQTT_RESEND_TOPIC, qos=1)
     return client
 
 
 def run_mqtt_client():
     """运行MQTT客户端"""
+    import asyncio
+
+    # 退出时把未发送的消息写入磁盘
+    atexit.register(mqtt_outbox.persist)
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    global mqtt_client
-    mqtt_client = loop.run_until_complete(setup_mqtt())
-    loop.run_forever()
+    loop.run_until_complete(mqtt_outbox.run(setup_mqtt))
 
 
-@app.route('/status', methods=['GET'])
-def status():
-    """获取服务器状态"""
-    return jsonify({
+def background_status():
+    """MQTT和PLY处理组件的状态，这些组件只在主进程中存在，其他进程返回 None"""
+    if mqtt_outbox is None:
+        return None
+    return {
+        'mqtt_connected': mqtt_outbox.connected,
+        'mqtt_outbox': mqtt_outbox.snapshot(),
+        'active_chunked_transfers': chunked_transfers.active_count(),
+        'ply_archive_cache': archive_cache.get_stats() if archive_cache else None,
+        'ply_watcher': {
+            'running': ply_watcher.running,
+            'mode': ply_watcher.mode,
+            'pending_tasks': ply_watcher.pending_count()
+        }
+    }
+
+
+def server_status():
+    """
+    服务器状态信息（多进程模式下为处理该请求的工作进程的状态）。
+    多进程模式下MQTT和PLY处理部分取自主进程最近一次写入的快照（最多延迟 METRICS_SHARE_INTERVAL 秒），
+    background_pid 为主进程的PID。
+    """
+    status = {
         'status': 'running',
         'timestamp': datetime.now().isoformat(),
-        'mqtt_connected': mqtt_client and mqtt_client.is_connected,
+        'pid': os.getpid(),
         'worker_threads': len(executor._threads),
-        'ply_watch_dir': PLY_CHECK_PATH
-    })
+        'ingest_queue_depth': executor._work_queue.qsize(),
+        'ingest_slots_free': ingest_slots._value,
+        'ply_watch_dir': PLY_CHECK_PATH,
+        'ply_transfer_mode': PLY_TRANSFER_MODE,
+        'batches': batch_store.counts(),
+        'jobs': job_queue.counts(),
+        'dedup': blob_store.get_stats() if blob_store else None,
+        'thumbnails': thumbnail_cache.get_stats(),
+        'validation': validation_stats.snapshot()
+    }
+    background = background_status()
+    if background is not None:
+        status.update(background)
+    elif shared_metrics is not None:
+        for pid, background in shared_metrics.peer_status():
+            status.update(background, background_pid=pid)
+    return status
+
+
+def metrics_text():
+    """Prometheus 指标文本，多进程模式下汇总所有进程"""
+    return shared_metrics.render() if shared_metrics else metrics.render()
+
+
+def upload_rel_path(rel_path):
+    """
+    检查URL中相对 uploaded_images 的路径并转换为本地路径格式。
+    不允许空段、.. 以及以 . 开头的内部目录（.sessions、.blobs、.thumbs），
+    不允许含 : 的段（Windows 盘符 C:、C:foo 和NTFS数据流），
+    规范化后的路径（解析符号链接）必须仍在 uploaded_images 之内，无效时抛出 ValueError。
+    """
+    parts = rel_path.replace('\\', '/').split('/')
+    if any(not part or part.startswith('.') or ':' in part for part in parts):
+        raise ValueError('路径无效')
+    path = os.path.normpath(os.path.join(*parts))
+    root = os.path.realpath(UPLOAD_FOLDER)
+    if os.path.isabs(path) or os.path.commonpath([root, os.path.realpath(os.path.join(root, path))]) != root:
+        raise ValueError('路径无效')
+    return path
+
+
+def get_thumbnail(rel_path, if_none_match):
+    """
+    查找图片的缩略图，缓存中没有时在线程池中生成。
+    返回 (状态码, 缩略图路径, ETag)；客户端缓存仍有效时状态码为304、路径为 None；
+    出错时第二项为错误响应体。
+    """
+    try:
+        rel_path = upload_rel_path(rel_path)
+        if rel_path.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+            raise ValueError('只支持JPEG图片')
+        # ETag 只由原图的 stat 信息决定，客户端缓存有效时不读取也不生成缩略图
+        etag = thumbnail_cache.etag(rel_path)
+    except ValueError as e:
+        return 400, {'code': 400, 'message': str(e)}, None
+    except FileNotFoundError:
+        return 404, {'code': 404, 'message': '图片不存在'}, None
+    if if_none_match.contains(etag):
+        return 304, None, etag
+    try:
+        path, etag = executor.submit(thumbnail_cache.get, rel_path).result()
+    except FileNotFoundError:
+        return 404, {'code': 404, 'message': '图片不存在'}, None
+    except Exception as e:
+        logger.error(f"生成缩略图失败 {rel_path}: {str(e)}")
+        return 422, {'code': 422, 'message': f'无法生成缩略图: {str(e)}'}, None
+    # send_file 把相对路径解释为相对于应用目录，这里给出绝对路径
+    return 200, os.path.abspath(path), etag
+
+
+@bp.route('/thumbnails/<path:rel_path>', methods=['GET'])
+def thumbnail_route(rel_path):
+    """获取上传图片的缩略图，路径相对于 uploaded_images，支持 If-None-Match"""
+    code, result, etag = get_thumbnail(rel_path, request.if_none_match)
+    if code == 200:
+        response = send_file(result, mimetype='image/jpeg', conditional=False, etag=False,
+                             max_age=THUMBNAIL_MAX_AGE)
+    elif code == 304:
+        response = make_response('', 304)
+    else:
+        return jsonify(result), code
+    response.set_etag(etag)
+    return response
 
 
-def run_server():
+def query_images(args):
+    """
+    按条件查询图片索引。条件：type（model/craft）、value、project、track、batch_id、sha256；
+    分页：limit，以及上一页返回的 next_cursor 作为 cursor。
+    """
+    try:
+        limit = min(int(args.get('limit', IMAGE_QUERY_LIMIT)), IMAGE_QUERY_MAX_LIMIT)
+        if limit <= 0:
+            raise ValueError(limit)
+    except ValueError:
+        return {'code': 400, 'message': '分页大小无效'}, 400
+    upload_type = args.get('type')
+    items, next_cursor = image_index.query(
+        category=category_folder(upload_type) if upload_type else None,
+        value=args.get('value'),
+        project=args.get('project'),
+        track=args.get('track'),
+        batch_id=args.get('batch_id'),
+        sha256=args.get('sha256'),
+        cursor=args.get('cursor'),
+        limit=limit
+    )
+    for item in items:
+        item['url'] = f"/files/{quote(item['rel_path'])}"
+        item['thumbnail_url'] = f"/thumbnails/{quote(item['rel_path'])}"
+    return {'code': 200, 'count': len(items), 'items': items, 'next_cursor': next_cursor}, 200
+
+
+def image_summary(args):
+    """项目的图片数、总字节数和轨迹列表，需要 type、value、project"""
+    if not all(args.get(name) for name in ('type', 'value', 'project')):
+        return {'code': 400, 'message': '需要 type、value 和 project 参数'}, 400
+    summary = image_index.summary(category_folder(args['type']), args['value'], args['project'])
+    return {'code': 200, **summary}, 200
+
+
+def resolve_download(rel_path):
+    """下载路径对应的本地文件，返回 (状态码, 绝对路径或错误响应体)"""
+    try:
+        rel_path = upload_rel_path(rel_path)
+    except ValueError as e:
+        return 400, {'code': 400, 'message': str(e)}
+    path = os.path.abspath(os.path.join(UPLOAD_FOLDER, rel_path))
+    # .part 是正在写入的临时文件
+    if path.endswith('.part') or not os.path.isfile(path):
+        return 404, {'code': 404, 'message': '文件不存在'}
+    return 200, path
+
+
+@bp.route('/files/<path:rel_path>', methods=['GET'])
+def download_route(rel_path):
+    """
+    下载 uploaded_images 下的文件，支持 Range 断点续传和 If-None-Match/If-Modified-Since 条件请求。
+    文件内容由waitress从文件对象直接写入连接（wsgi.file_wrapper），不经过应用线程逐块复制。
+    """
+    code, result = resolve_download(rel_path)
+    if code != 200:
+        return jsonify(result), code
+    response = send_file(result, conditional=True, max_age=DOWNLOAD_MAX_AGE)
+    bytes_out_total.inc('download', amount=response.content_length or 0)
+    return response
+
+
+def prepare_export(args):
+    """
+    检查项目导出参数，返回 (状态码, ZIP字节块生成器或错误响应体, 下载文件名)。
+    必需：type、value、project；可选过滤条件：track（轨迹名）、batch_id（上传任务ID或会话ID）、batch_number。
+    导出内容来自图片索引，启用索引前的历史文件需先执行 --rebuild-index。
+    """
+    if not all(args.get(name) for name in ('type', 'value', 'project')):
+        return 400, {'code': 400, 'message': '需要 type、value 和 project 参数'}, None
+    try:
+        batch_number = int(args['batch_number']) if args.get('batch_number') else None
+    except ValueError:
+        return 400, {'code': 400, 'message': '批次号无效'}, None
+    filters = {
+        'category': category_folder(args['type']),
+        'value': args['value'],
+        'project': args['project'],
+        'track': args.get('track'),
+        'batch_id': args.get('batch_id'),
+        'batch_number': batch_number
+    }
+    items, _ = image_index.query(limit=1, **filters)
+    if not items:
+        return 404, {'code': 404, 'message': '没有符合条件的图片'}, None
+    parts = [args['project'], args.get('track'), args.get('batch_id'), args.get('batch_number')]
+    filename = '_'.join(part for part in parts if part) + '.zip'
+    return 200, export_chunks(filters, filename), filename
+
+
+def export_members(filters):
+    """按 rel_path 顺序分页读取索引，产出 (本地路径, 压缩包内名称)，压缩包内名称从项目目录开始"""
+    cursor = None
+    while True:
+        items, cursor = image_index.query(cursor=cursor, limit=EXPORT_PAGE_SIZE, **filters)
+        for item in items:
+            parts = item['rel_path'].split('/')
+            yield os.path.join(UPLOAD_FOLDER, *parts), '/'.join(parts[2:])
+        if cursor is None:
+            return
+
+
+def export_chunks(filters, filename):
+    """逐块生成导出的ZIP，客户端断开时生成器被关闭，记录已发送的字节数"""
+    # zipfile 只在导出时才加载
+    from zip_stream import stream_zip
+
+    start = time.perf_counter()
+    sent = 0
+    completed = False
+    try:
+        for chunk in stream_zip(export_members(filters), STREAM_CHUNK_SIZE):
+            sent += len(chunk)
+            bytes_out_total.inc('export', amount=len(chunk))
+            yield chunk
+        completed = True
+    finally:
+        logger.info(f"项目导出{'完成' if completed else '中断'}: {filename}, {sent} 字节, "
+                    f"耗时: {time.perf_counter() - start:.1f} 秒")
+
+
+def attachment_header(filename):
+    """Content-Disposition 头，非ASCII文件名（中文项目名）通过 filename* 给出"""
+    try:
+        fallback = filename.encode('ascii').decode('ascii').replace('"', '')
+    except UnicodeEncodeError:
+        fallback = 'export.zip'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+@bp.route('/export', methods=['GET'])
+def export_route():
+    """
+    把项目（含轨迹）的图片打包为ZIP流式下载，边读文件边发送，不生成临时压缩包。
+    响应没有 Content-Length，waitress 使用分块传输编码。
+    """
+    code, result, filename = prepare_export(request.args)
+    if code != 200:
+        return jsonify(result), code
+    return Response(result, mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(filename)})
+
+
+@bp.route('/ply/<sha256>.zip', methods=['GET'])
+def ply_result_route(sha256):
+    """下载 reference 模式发布的PLY压缩包，支持 Range 和条件请求；name 参数指定保存的文件名"""
+    path = ply_results.path(sha256)
+    if path is None:
+        return jsonify({'code': 404, 'message': 'PLY压缩包不存在或已过期'}), 404
+    response = send_file(os.path.abspath(path), mimetype='application/zip', as_attachment=True,
+                         download_name=request.args.get('name') or f'{sha256}.zip', conditional=True,
+                         max_age=PLY_RESULT_TTL)
+    bytes_out_total.inc('ply_download', amount=response.content_length or 0)
+    return response
+
+
+@bp.route('/images', methods=['GET'])
+def images_route():
+    """分页查询已上传图片的元数据"""
+    payload, code = query_images(request.args)
+    return jsonify(payload), code
+
+
+@bp.route('/images/summary', methods=['GET'])
+def image_summary_route():
+    """项目的图片统计"""
+    payload, code = image_summary(request.args)
+    return jsonify(payload), code
+
+
+@bp.route('/traces', methods=['GET'])
+def traces_route():
+    """最近任务的耗时概况，按总耗时从长到短排列"""
+    payload, code = recent_traces(request.args)
+    return jsonify(payload), code
+
+
+@bp.route('/traces/<task_id>', methods=['GET'])
+def task_trace_route(task_id):
+    """任务各阶段的span"""
+    payload, code = task_trace(task_id)
+    return jsonify(payload), code
+
+
+@bp.route('/tasks/<task_id>', methods=['GET'])
+def task_status_route(task_id):
+    """查询PLY任务状态"""
+    payload, code = task_status(task_id)
+    return jsonify(payload), code
+
+
+@bp.route('/status', methods=['GET'])
+def status():
+    """获取服务器状态"""
+    return jsonify(server_status())
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Prometheus 指标"""
+    return metrics_text(), 200, {'Content-Type': metrics.content_type}
+
+
+@bp.before_request
+def count_request_start():
+    inflight_requests.inc()
+
+
+@bp.teardown_request
+def count_request_end(exc):
+    inflight_requests.dec()
+
+
+def create_asgi_app():
+    """
+    创建ASGI应用（需要安装 quart 和 hypercorn）。
+    HTTP处理和MQTT客户端共用同一个事件循环，慢速上传的连接不再各占一个线程。
+    """
+    import asyncio
+    from quart import Quart, Request as QuartRequest, jsonify as quart_jsonify, request as quart_request
+    from quart import make_response as quart_make_response, send_file as quart_send_file
+    from quart import Response as QuartResponse
+
+    configure_logging()
+    init_services()
+
+    class StreamingQuartRequest(QuartRequest):
+        """使用临时文件接收multipart文件部分的请求类"""
+
+        def make_form_data_parser(self):
+            return self.form_data_parser_class(
+                max_content_length=self.max_content_length,
+                max_form_memory_size=self.max_form_memory_size,
+                max_form_parts=self.max_form_parts,
+                cls=self.parameter_storage_class,
+                stream_factory=temp_file_stream_factory
+            )
+
+    asgi_app = Quart(__name__)
+    asgi_app.request_class = StreamingQuartRequest
+    asgi_app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+    async def run_blocking(func, *args):
+        """在默认线程池中执行SQLite查询和文件操作，不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    @asgi_app.before_serving
+    async def start_mqtt():
+        # 发件箱的发送协程负责连接和重连
+        asgi_app.mqtt_task = asyncio.get_running_loop().create_task(mqtt_outbox.run(setup_mqtt))
+
+    @asgi_app.after_serving
+    async def stop_mqtt():
+        await mqtt_outbox.stop()
+        await asgi_app.mqtt_task
+
+    @asgi_app.route('/upload', methods=['POST'])
+    async def upload_image_async():
+        """处理文件上传请求"""
+        task_id = str(uuid.uuid4())
+        try:
+            with upload_stage_seconds.time('total'):
+                with upload_stage(task_id, 'parse', bytes=quart_request.content_length or 0):
+                    form = await quart_request.form
+                    files = await quart_request.files
+                bytes_in_total.inc('upload', amount=quart_request.content_length or 0)
+                payload, code = await process_upload_async(form, files.getlist('files[]'), task_id)
+            return quart_jsonify(payload), code
+        except Exception as e:
+            logger.error(f"上传处理错误: {str(e)}")
+            return quart_jsonify({
+                'code': 500,
+                'message': f'处理错误: {str(e)}'
+            }), 500
+
+    @asgi_app.route('/upload/sessions', methods=['POST'])
+    async def create_session_async():
+        """创建断点续传会话"""
+        params = await quart_request.get_json(silent=True) or await quart_request.form
+        payload, code = await run_blocking(create_upload_session, params)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/upload/sessions/<session_id>', methods=['GET'])
+    async def get_session_async(session_id):
+        """查询断点续传会话状态"""
+        payload, code = await run_blocking(get_upload_session, session_id)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/upload/sessions/<session_id>', methods=['PUT', 'PATCH'])
+    async def write_chunk_async(session_id):
+        """写入分片，偏移量由查询参数 offset 指定，请求体为分片原始字节"""
+        try:
+            offset = int(quart_request.args.get('offset', '0'))
+        except ValueError:
+            return quart_jsonify({'code': 400, 'message': '分片偏移无效'}), 400
+        data = await quart_request.get_data(cache=False)
+        loop = asyncio.get_running_loop()
+        payload, code = await loop.run_in_executor(executor, write_upload_chunk, session_id, offset, [data])
+        bytes_in_total.inc('session', amount=len(data))
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/upload/sessions/<session_id>', methods=['DELETE'])
+    async def abort_session_async(session_id):
+        """放弃断点续传会话"""
+        payload, code = await run_blocking(abort_upload_session, session_id)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/thumbnails/<path:rel_path>', methods=['GET'])
+    async def thumbnail_async(rel_path):
+        """获取上传图片的缩略图，路径相对于 uploaded_images，支持 If-None-Match"""
+        # get_thumbnail 会等待线程池中的生成任务，自身放在默认线程池中执行
+        code, result, etag = await run_blocking(get_thumbnail, rel_path, quart_request.if_none_match)
+        if code == 200:
+            response = await quart_send_file(result, mimetype='image/jpeg')
+            response.cache_control.max_age = THUMBNAIL_MAX_AGE
+        elif code == 304:
+            response = await quart_make_response('', 304)
+        else:
+            return quart_jsonify(result), code
+        response.set_etag(etag)
+        return response
+
+    @asgi_app.route('/files/<path:rel_path>', methods=['GET'])
+    async def download_async(rel_path):
+        """下载 uploaded_images 下的文件，支持 Range 和条件请求"""
+        code, result = await run_blocking(resolve_download, rel_path)
+        if code != 200:
+            return quart_jsonify(result), code
+        response = await quart_send_file(result, conditional=True, cache_timeout=DOWNLOAD_MAX_AGE)
+        bytes_out_total.inc('download', amount=response.content_length or 0)
+        return response
+
+    @asgi_app.route('/export', methods=['GET'])
+    async def export_async():
+        """把项目的图片打包为ZIP流式下载"""
+        code, result, filename = await run_blocking(prepare_export, quart_request.args)
+        if code != 200:
+            return quart_jsonify(result), code
+        loop = asyncio.get_running_loop()
+
+        async def body():
+            # 读文件和生成ZIP在默认线程池中逐块进行，不阻塞事件循环
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(None, next, result, None)
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                result.close()
+
+        response = QuartResponse(body(), mimetype='application/zip',
+                                 headers={'Content-Disposition': attachment_header(filename)})
+        # 大项目的导出时间可能超过 RESPONSE_TIMEOUT（默认60秒）
+        response.timeout = None
+        return response
+
+    @asgi_app.route('/ply/<sha256>.zip', methods=['GET'])
+    async def ply_result_async(sha256):
+        """下载 reference 模式发布的PLY压缩包，支持 Range 和条件请求"""
+        path = await run_blocking(ply_results.path, sha256)
+        if path is None:
+            return quart_jsonify({'code': 404, 'message': 'PLY压缩包不存在或已过期'}), 404
+        response = await quart_send_file(os.path.abspath(path), mimetype='application/zip', as_attachment=True,
+                                         attachment_filename=quart_request.args.get('name') or f'{sha256}.zip',
+                                         conditional=True, cache_timeout=PLY_RESULT_TTL)
+        bytes_out_total.inc('ply_download', amount=response.content_length or 0)
+        return response
+
+    @asgi_app.route('/images', methods=['GET'])
+    async def images_async():
+        """分页查询已上传图片的元数据"""
+        payload, code = await run_blocking(query_images, quart_request.args)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/images/summary', methods=['GET'])
+    async def image_summary_async():
+        """项目的图片统计"""
+        payload, code = await run_blocking(image_summary, quart_request.args)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/traces', methods=['GET'])
+    async def traces_async():
+        """最近任务的耗时概况，按总耗时从长到短排列"""
+        payload, code = await run_blocking(recent_traces, quart_request.args)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/traces/<task_id>', methods=['GET'])
+    async def task_trace_async(task_id):
+        """任务各阶段的span"""
+        payload, code = await run_blocking(task_trace, task_id)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/tasks/<task_id>', methods=['GET'])
+    async def task_status_async(task_id):
+        """查询PLY任务状态"""
+        payload, code = await run_blocking(task_status, task_id)
+        return quart_jsonify(payload), code
+
+    @asgi_app.route('/status', methods=['GET'])
+    async def status_async():
+        """获取服务器状态"""
+        return quart_jsonify(await run_blocking(server_status))
+
+    @asgi_app.route('/metrics', methods=['GET'])
+    async def metrics_async():
+        """Prometheus 指标"""
+        return await run_blocking(metrics_text), 200, {'Content-Type': metrics.content_type}
+
+    @asgi_app.before_request
+    async def count_request_start_async():
+        inflight_requests.inc()
+
+    @asgi_app.teardown_request
+    async def count_request_end_async(exc):
+        inflight_requests.dec()
+
+    return asgi_app
+
+
+def run_server(server='waitress', host='0.0.0.0', port=5000, job_workers=JOB_WORKERS):
     """运行服务器"""
-    logger.info('启动服务...')
+    if server == 'asgi':
+        asgi_app = create_asgi_app()
+    else:
+        app = create_app()
+    logger.info(f'启动服务... 模式: {server}')
+
+    # 启动PLY输出目录监听和任务线程
+    if PLY_WATCH:
+        ply_watcher.start()
+    start_job_workers(job_workers)
+    Thread(target=batch_expiry_loop, daemon=True, name='batch-expiry').start()
+
+    if server == 'asgi':
+        import asyncio
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+
+        # MQTT客户端在before_serving中连接到同一个事件循环
+        config = Config()
+        config.bind = [f'{host}:{port}']
+        asyncio.run(hypercorn_serve(asgi_app, config))
+        return
 
     # 启动MQTT客户端线程
     mqtt_thread = Thread(target=run_mqtt_client, daemon=True)
     mqtt_thread.start()
 
     # 启动Web服务器
-    serve(app, host='0.0.0.0', port=5000, threads=multiprocessing.cpu_count() * 2)
+    from waitress import serve
+
+    serve(app, host=host, port=port, threads=os.cpu_count() * 2)
+
+
+def serve_http_process(sock, threads):
+    """多进程模式下的HTTP工作进程：在主进程创建的监听套接字上接收连接"""
+    from waitress import create_server
+
+    global shared_metrics
+    app = create_app(background=False)
+    shared_metrics = SharedMetrics(metrics, METRICS_SHARE_FOLDER, METRICS_SHARE_INTERVAL)
+    shared_metrics.start()
+    logger.info(f'HTTP工作进程已启动 - PID: {os.getpid()}')
+    create_server(app, sockets=[sock], threads=threads).run()
+
+
+def run_prefork(processes, host='0.0.0.0', port=5000, job_workers=JOB_WORKERS):
+    """
+    多进程运行：主进程创建监听套接字后启动 processes 个HTTP工作进程共享接收连接，
+    图片写盘校验分散到多个进程并行执行。
+    主进程运行MQTT客户端、PLY目录监听和任务线程，工作进程通过SQLite中的
+    任务队列、项目批次和断点续传会话与主进程及彼此共享状态，同一项目的批次可以由任意进程接收。
+    工作进程用 spawn 方式启动（Windows 不支持 fork），意外退出时重新启动。
+    各进程定期把指标快照写入 METRICS_SHARE_FOLDER，任一工作进程的 /metrics 汇总全部进程（包括主进程的
+    PLY处理耗时和发件箱深度），/status 中附带主进程的MQTT和PLY处理状态。
+    """
+    global shared_metrics
+    configure_logging()
+    init_services()
+    shared_metrics = SharedMetrics(metrics, METRICS_SHARE_FOLDER, METRICS_SHARE_INTERVAL, status=background_status)
+    shared_metrics.start(clear=True)
+    logger.info(f'启动服务... 模式: waitress, 工作进程数: {processes}')
+
+    if PLY_WATCH:
+        ply_watcher.start()
+    start_job_workers(job_workers)
+    Thread(target=batch_expiry_loop, daemon=True, name='batch-expiry').start()
+    Thread(target=run_mqtt_client, daemon=True).start()
+
+    sock = socket.create_server((host, port), backlog=1024)
+    ctx = multiprocessing.get_context('spawn')
+    threads = max(4, os.cpu_count() * 2 // processes)
+
+    def start_process():
+        process = ctx.Process(target=serve_http_process, args=(sock, threads), daemon=True)
+        process.start()
+        return process
+
+    workers = [start_process() for _ in range(processes)]
+    try:
+        while True:
+            time.sleep(PROCESS_RESTART_DELAY)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.error(f'HTTP工作进程已退出 - PID: {process.pid}, 退出码: {process.exitcode}，重新启动')
+                    workers[i] = start_process()
+    except KeyboardInterrupt:
+        logger.info('正在停止HTTP工作进程...')
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+        sock.close()
+
+
+def run_worker(job_workers=JOB_WORKERS, worker_id='worker'):
+    """只处理PLY任务队列，不提供HTTP服务；worker_id 区分该进程的MQTT客户端ID和状态目录"""
+    configure_logging()
+    init_services(instance=worker_id)
+    logger.info(f'启动任务处理进程... 线程数: {job_workers}')
+    if PLY_WATCH:
+        ply_watcher.start()
+    Thread(target=run_mqtt_client, daemon=True).start()
+    start_job_workers(max(1, job_workers) - 1)
+    job_worker_loop()
+
+
+# --profile-startup 在子进程中执行的启动过程：导入模块、创建应用、处理第一个 /status 请求
+PROFILE_STARTUP_CODE = '''
+import json, sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+sys.stderr.write('profile-startup-begin\\n')
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+response = app.test_client().get('/status')
+served = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'create_app': created - imported,
+                  'first_status': served - created, 'total': served - start,
+                  'status_code': response.status_code}}))
+'''
+
+
+def profile_startup(top=15):
+    """
+    在新的解释器中（python -X importtime）冷启动服务并请求一次 /status，
+    打印各阶段耗时和耗时最多的导入。
+    """
+    code = PROFILE_STARTUP_CODE.format(path=os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, encoding='utf-8')
+    if result.returncode != 0:
+        print(result.stderr)
+        return result.returncode
+
+    # importtime 每行格式：import time: 自身(us) | 累计(us) | 模块名，缩进表示嵌套层级
+    imports = []
+    lines = result.stderr.splitlines()
+    begin = lines.index('profile-startup-begin') if 'profile-startup-begin' in lines else 0
+    for line in lines[begin:]:
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1 and name.strip() != 'main':
+            imports.append((int(cumulative_us) / 1000, name.strip()))
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"导入main: {timings['import'] * 1000:.1f} ms")
+    print(f"create_app: {timings['create_app'] * 1000:.1f} ms")
+    print(f"首个/status: {timings['first_status'] * 1000:.1f} ms (HTTP {timings['status_code']})")
+    print(f"合计: {timings['total'] * 1000:.1f} ms")
+    print(f"耗时最多的 {top} 个导入（累计）:")
+    for ms, name in sorted(imports, reverse=True)[:top]:
+        print(f"  {ms:8.1f} ms  {name}")
+    return 0
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='图片上传服务')
+    parser.add_argument('--server', choices=['waitress', 'asgi'], default='waitress',
+                        help='waitress: Flask+waitress线程模式; asgi: Quart+hypercorn事件循环模式')
+    parser.add_argument('--host', default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--gc-blobs', action='store_true', help='回收去重存储中不再被引用的blob后退出')
+    parser.add_argument('--rebuild-index', action='store_true', help='扫描 uploaded_images 重建图片元数据索引后退出')
+    parser.add_argument('--worker', action='store_true', help='只运行PLY任务处理进程，不提供HTTP服务')
+    parser.add_argument('--worker-id', default='worker',
+                        help='--worker 进程的实例名，同时运行多个 --worker 进程时各自指定不同的值')
+    parser.add_argument('--job-workers', type=int, default=JOB_WORKERS,
+                        help='处理PLY任务的线程数，HTTP服务设为0时任务交给 --worker 进程')
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help='HTTP工作进程数，大于1时多个进程共享监听端口（仅waitress模式）')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='冷启动到首个 /status 响应的耗时，以及各模块导入耗时')
+    args = parser.parse_args()
+    if args.processes > 1 and args.server == 'asgi':
+        parser.error('--processes 只支持waitress模式')
+    return args
 
 
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    args = parse_args()
+    if args.profile_startup:
+        sys.exit(profile_startup())
+    if args.gc_blobs:
+        configure_logging()
+        BlobStore(BLOB_FOLDER).cleanup()
+    elif args.rebuild_index:
+        configure_logging()
+        ImageIndex(IMAGE_INDEX_DB_PATH, UPLOAD_FOLDER).rebuild()
+    elif args.worker:
+        run_worker(args.job_workers, args.worker_id)
+    elif args.processes > 1:
+        run_prefork(args.processes, args.host, args.port, args.job_workers)
+    else:
+        run_server(args.server, args.host, args.port, args.job_workers)
@@ -0,0 +1,303 @@
+import glob
+import json
+import logging
+import math
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+# 默认的耗时分桶（秒），覆盖从毫秒级的校验到分钟级的打包
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, labels), value)
+                    for labels, value in sorted(self.values.items())]
+
+    def dump(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Gauge:
+    """当前值；给出 callback 时在导出时调用它取值"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        if self.callback:
+            try:
+                value = self.callback()
+            except Exception:
+                value = float('nan')
+        else:
+            value = self.value
+        return [(self.name, '', value)]
+
+    def dump(self):
+        return [[[], self.samples()[0][2]]]
+
+
+class Histogram:
+    """
+    分桶直方图。observe 只做一次二分查找和一次加锁累加，
+    累计计数在导出时才计算，放在上传热路径上开销可以忽略。
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.series = {}  # 标签值 -> [各桶计数..., +Inf桶计数, 总和]
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """记录 with 块的耗时（异常时也记录）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self.lock:
+            snapshot = {labels: list(series) for labels, series in self.series.items()}
+        samples = []
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, series[:-1]):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', format_labels(self.labelnames, labels, [('le', bound)]),
+                                cumulative))
+            samples.append((f'{self.name}_sum', format_labels(self.labelnames, labels), series[-1]))
+            samples.append((f'{self.name}_count', format_labels(self.labelnames, labels), cumulative))
+        return samples
+
+    def dump(self):
+        with self.lock:
+            return [[list(labels), list(series)] for labels, series in self.series.items()]
+
+
+class MetricsRegistry:
+    """指标集合，render() 输出 Prometheus 文本格式（0.0.4）"""
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(self.prefix + name, documentation, labelnames))
+
+    def gauge(self, name, documentation, callback=None):
+        return self._add(Gauge(self.prefix + name, documentation, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def render(self):
+        return render_metrics(self.metrics)
+
+    def dump(self):
+        """全部指标的定义和当前原始值（可JSON序列化），用于多进程汇总"""
+        dump = []
+        for metric in self.metrics:
+            entry = {'name': metric.name, 'type': metric.type_name, 'documentation': metric.documentation,
+                     'labelnames': list(getattr(metric, 'labelnames', ())), 'values': metric.dump()}
+            if isinstance(metric, Histogram):
+                entry['buckets'] = list(metric.buckets)
+            dump.append(entry)
+        return dump
+
+
+def render_metrics(metrics):
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type_name}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class _PerProcessGauge:
+    """汇总时的仪表盘：各进程的当前值不能相加，每个进程一条序列，带 pid 标签"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+
+    def samples(self):
+        return [(self.name, format_labels(('pid',), (pid,)), value) for pid, value in sorted(self.values.items())]
+
+
+def merge_dumps(dumps):
+    """
+    汇总多个进程的 MetricsRegistry.dump()，dumps 为 [(pid, dump)]，返回可交给 render_metrics 的指标列表。
+    计数器和直方图按标签值相加，仪表盘按进程分别输出。
+    """
+    merged = {}
+    for pid, dump in dumps:
+        for entry in dump:
+            metric = merged.get(entry['name'])
+            if metric is None:
+                if entry['type'] == 'counter':
+                    metric = Counter(entry['name'], entry['documentation'], entry['labelnames'])
+                elif entry['type'] == 'histogram':
+                    metric = Histogram(entry['name'], entry['documentation'], entry['labelnames'], entry['buckets'])
+                else:
+                    metric = _PerProcessGauge(entry['name'], entry['documentation'])
+                merged[entry['name']] = metric
+            for labels, value in entry['values']:
+                labels = tuple(labels)
+                if entry['type'] == 'counter':
+                    metric.values[labels] = metric.values.get(labels, 0) + value
+                elif entry['type'] == 'histogram':
+                    current = metric.series.get(labels)
+                    metric.series[labels] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    metric.values[str(pid)] = value
+    return list(merged.values())
+
+
+class SharedMetrics:
+    """
+    多进程共享指标：每个进程每隔 interval 秒把 registry.dump() 写入 folder/<pid>.json，
+    render() 把本进程的实时值与其他进程的快照汇总输出，任何一个进程响应 /metrics 的结果都一样（相差不超过一个间隔）。
+    已退出进程的快照保留，计数器和直方图不会因为进程重启而回落；超过3个间隔没有更新的快照不再输出仪表盘。
+    status() 的结果随快照一起写入，供其他进程在 /status 中显示。
+    """
+
+    def __init__(self, registry, folder, interval=5.0, status=None):
+        self.registry = registry
+        self.folder = folder
+        self.interval = interval
+        self.status = status
+        self.path = os.path.join(folder, f'{os.getpid()}.json')
+
+    def start(self, clear=False):
+        """开始定期写入快照；clear 为真时（主进程启动时）先删除上次运行留下的快照"""
+        os.makedirs(self.folder, exist_ok=True)
+        if clear:
+            for path in glob.glob(os.path.join(self.folder, '*.json')):
+                os.remove(path)
+        self.write()
+        Thread(target=self._loop, daemon=True, name='metrics-share').start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as e:
+                # Windows下其他进程正在读取时无法替换，下次再写
+                logger.debug(f"写入指标快照失败: {str(e)}")
+
+    def write(self):
+        data = {'pid': os.getpid(), 'time': time.time(), 'metrics': self.registry.dump(),
+                'status': self.status() if self.status else None}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def peers(self):
+        """其他进程的快照 [(数据, 是否仍在更新)]"""
+        now = time.time()
+        peers = []
+        for path in glob.glob(os.path.join(self.folder, '*.json')):
+            if path == self.path:
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # 正在被替换
+            peers.append((data, now - data['time'] <= self.interval * 3))
+        return peers
+
+    def render(self):
+        dumps = [(os.getpid(), self.registry.dump())]
+        for data, fresh in self.peers():
+            dump = data['metrics'] if fresh else [entry for entry in data['metrics'] if entry['type'] != 'gauge']
+            dumps.append((data['pid'], dump))
+        return render_metrics(merge_dumps(dumps))
+
+    def peer_status(self):
+        """仍在更新的其他进程随快照写入的 status，[(pid, status)]"""
+        return [(data['pid'], data['status']) for data, fresh in self.peers() if fresh and data['status']]
@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class MqttOutbox:
+    """
+    MQTT发件箱。
+
+    任意线程调用 put() 入队，MQTT客户端所在事件循环中只有一个发送协程（run）
+    按入队顺序取出并调用 client.publish，gmqtt客户端只在自己的事件循环中被访问。
+
+    - 内存队列按字节数限制（max_memory_bytes）。超出时新消息追加到磁盘溢出文件，
+      内存队列发完后再从磁盘按顺序读回；溢出文件超过 max_disk_bytes 时丢弃新消息并计数。
+      溢出文件在重启后保留，启动时继续发送其中的消息。
+    - 一次唤醒最多连续发送 batch_messages 条或 batch_bytes 字节，再让出事件循环，
+      小消息不会每条都触发一次调度。
+    - 首次连接失败或连接断开时消息留在队列中，按指数退避重新连接；
+      断开后由gmqtt自动重连，超过 reconnect_max 秒仍未恢复时丢弃该客户端，重新创建并连接。
+    - 从溢出文件读回消息在线程池中进行，读文件期间不持有锁，不阻塞事件循环和入队的线程。
+    """
+
+    def __init__(self, spill_path, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024,
+                 batch_messages=50, batch_bytes=1024 * 1024, put_timeout=30,
+                 reconnect_min=1.0, reconnect_max=60.0):
+        self.spill_path = spill_path
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.batch_messages = batch_messages
+        self.batch_bytes = batch_bytes
+        self.put_timeout = put_timeout
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.client = None
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
+        self.running = False
+        self.cond = threading.Condition()
+        self.spill_lock = threading.Lock()  # 读回溢出文件的线程和 persist 互斥
+        self.queue = deque()  # (topic, payload, qos, 入队时间)
+        self.memory_bytes = 0
+        self.spill_count = 0  # 溢出文件中尚未读回的消息数
+        self.spill_offset = 0  # 下一条待读回记录在溢出文件中的位置
+        self.stats = {
+            'published': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'batches': 0,
+            'reconnects': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'latency_last': 0.0
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+        self._load_spill()
+
+    def _load_spill(self):
+        """上次退出时未发送的溢出消息"""
+        try:
+            with open(self.spill_path, 'rb') as f:
+                self.spill_count = sum(1 for line in f if line.strip())
+        except FileNotFoundError:
+            return
+        if self.spill_count:
+            logger.info(f"MQTT发件箱恢复溢出消息: {self.spill_count} 条")
+
+    @property
+    def connected(self):
+        return bool(self.client and self.client.is_connected)
+
+    def put(self, topic, payload, qos=1, wait=False):
+        """
+        入队一条消息，payload 为已序列化的字符串，返回是否已入队（溢出到磁盘也算入队）。
+        wait 为真时内存队列已满且连接正常则最多等待 put_timeout 秒腾出空间，
+        用于连续发送大量分块的生产者；仍无空间或连接断开时写入磁盘。
+        """
+        size = len(payload)
+        entry = (topic, payload, qos, time.time())
+        with self.cond:
+            if wait and self.spill_count == 0 and threading.current_thread() is not self.loop_thread:
+                deadline = time.monotonic() + self.put_timeout
+                while (self.memory_bytes and self.memory_bytes + size > self.max_memory_bytes
+                       and self.connected and time.monotonic() < deadline):
+                    self.cond.wait(deadline - time.monotonic())
+            # 磁盘上已有消息时新消息也写入磁盘，保持发送顺序
+            if self.spill_count == 0 and (not self.memory_bytes or self.memory_bytes + size <= self.max_memory_bytes):
+                self.queue.append(entry)
+                self.memory_bytes += size
+            elif not self._spill(entry):
+                self.stats['dropped'] += 1
+                logger.error(f"MQTT发件箱已满，丢弃消息: {topic}")
+                return False
+        self._notify()
+        return True
+
+    def _spill(self, entry):
+        """追加到溢出文件（调用方持有锁）"""
+        record = (json.dumps({'topic': entry[0], 'payload': entry[1], 'qos': entry[2], 'enqueued': entry[3]},
+                             ensure_ascii=False) + '\n').encode('utf-8')
+        try:
+            if os.path.exists(self.spill_path) and \
+                    os.path.getsize(self.spill_path) + len(record) > self.max_disk_bytes:
+                return False
+            with open(self.spill_path, 'ab') as f:
+                f.write(record)
+        except OSError as e:
+            logger.error(f"MQTT发件箱写入溢出文件失败: {str(e)}")
+            return False
+        self.spill_count += 1
+        self.stats['spilled'] += 1
+        return True
+
+    def _notify(self):
+        loop = self.loop
+        if loop is not None and self.wakeup is not None:
+            try:
+                loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _take(self):
+        """从内存队列取出一批待发送的消息（内存队列为空时由 _take_spill 从溢出文件读回）"""
+        batch = []
+        batch_size = 0
+        with self.cond:
+            while self.queue and len(batch) < self.batch_messages and batch_size < self.batch_bytes:
+                entry = self.queue.popleft()
+                self.memory_bytes -= len(entry[1])
+                batch_size += len(entry[1])
+                batch.append(entry)
+            self.cond.notify_all()
+        return batch
+
+    def _take_spill(self):
+        """
+        在线程池中执行：内存队列为空时从溢出文件读回一批消息。
+        读文件时不持有 cond，其他线程可以继续入队（新消息只会追加在文件末尾）。
+        """
+        with self.spill_lock:
+            with self.cond:
+                if self.queue or not self.spill_count:
+                    return []
+                offset = self.spill_offset
+            batch, offset = self._read_records(offset)
+            with self.cond:
+                self._commit_read(offset, len(batch))
+                self.cond.notify_all()
+        return batch
+
+    def _read_spill(self):
+        """从溢出文件读回一批消息（调用方持有 spill_lock 和 cond）"""
+        batch, offset = self._read_records(self.spill_offset)
+        self._commit_read(offset, len(batch))
+        return batch
+
+    def _read_records(self, offset):
+        """从溢出文件的 offset 处读取一批完整的记录，返回 (消息列表, 下一条记录的位置)"""
+        batch = []
+        batch_size = 0
+        with open(self.spill_path, 'rb') as f:
+            f.seek(offset)
+            while len(batch) < self.batch_messages and batch_size < self.batch_bytes:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break  # 文件末尾，或其他线程正在追加的记录
+                offset = f.tell()
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                batch.append((record['topic'], record['payload'], record['qos'], record['enqueued']))
+                batch_size += len(record['payload'])
+        return batch, offset
+
+    def _commit_read(self, offset, count):
+        """记录读回的位置，全部读完后删除溢出文件（调用方持有 cond，此时没有线程在追加）"""
+        self.spill_offset = offset
+        self.spill_count -= count
+        if self.spill_count <= 0:
+            self.spill_count = 0
+            self.spill_offset = 0
+            os.remove(self.spill_path)
+
+    def _requeue(self, batch):
+        """发送失败的消息放回队首"""
+        with self.cond:
+            for entry in reversed(batch):
+                self.queue.appendleft(entry)
+                self.memory_bytes += len(entry[1])
+
+    async def run(self, connect):
+        """
+        发送协程，在MQTT客户端所在的事件循环中运行直到 stop()。
+        connect() 是创建并连接客户端的协程函数。
+        """
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.wakeup = asyncio.Event()
+        self.running = True
+        delay = self.reconnect_min
+        disconnected_since = None
+        while self.running:
+            if self.client is None:
+                try:
+                    self.client = await connect()
+                    delay = self.reconnect_min
+                    logger.info("MQTT发件箱已连接")
+                except Exception as e:
+                    self.stats['reconnects'] += 1
+                    logger.error(f"连接MQTT服务器失败，{delay:g}秒后重试: {str(e)}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_max)
+                    continue
+
+            if not self.client.is_connected:
+                # 连接断开后由gmqtt自动重连，期间消息保留在队列中
+                now = time.monotonic()
+                if disconnected_since is None:
+                    disconnected_since = now
+                elif now - disconnected_since > self.reconnect_max:
+                    logger.warning(f"MQTT连接断开超过 {self.reconnect_max:g} 秒，重新创建客户端")
+                    client, self.client = self.client, None
+                    disconnected_since = None
+                    try:
+                        # 停止旧客户端的自动重连
+                        await client.disconnect()
+                    except Exception:
+                        pass
+                    continue
+                await asyncio.sleep(self.reconnect_min)
+                continue
+            disconnected_since = None
+
+            batch = self._take()
+            if not batch and self.spill_count:
+                batch = await self.loop.run_in_executor(None, self._take_spill)
+            if not batch:
+                self.wakeup.clear()
+                if self.queue:
+                    continue
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for i, (topic, payload, qos, enqueued) in enumerate(batch):
+                try:
+                    self.client.publish(topic, payload, qos=qos, retain=False)
+                except Exception as e:
+                    logger.error(f"MQTT发布失败，稍后重试: {str(e)}")
+                    self._requeue(batch[i:])
+                    break
+                latency = time.time() - enqueued
+                self.stats['published'] += 1
+                self.stats['latency_total'] += latency
+                self.stats['latency_last'] = latency
+                self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+            self.stats['batches'] += 1
+            await asyncio.sleep(0)
+
+    async def stop(self):
+        """停止发送协程并断开连接"""
+        self.running = False
+        self.persist()
+        if self.connected:
+            await self.client.disconnect()
+
+    def persist(self):
+        """把内存中未发送的消息写入溢出文件，重启后继续发送（退出时调用）"""
+        with self.spill_lock, self.cond:
+            if not self.queue:
+                return
+            # 磁盘上的消息排在内存消息之后，先读出再按顺序整体重写
+            pending = list(self.queue)
+            self.queue.clear()
+            self.memory_bytes = 0
+            while self.spill_count:
+                pending.extend(self._read_spill())
+            written = sum(1 for entry in pending if self._spill(entry))
+            dropped = len(pending) - written
+            self.stats['dropped'] += dropped
+        logger.info(f"MQTT发件箱未发送消息已写入磁盘: {written} 条")
+        if dropped:
+            logger.error(f"MQTT发件箱溢出文件已满或写入失败，丢弃未发送消息: {dropped} 条")
+
+    def snapshot(self):
+        """/status 中的发件箱统计"""
+        with self.cond:
+            published = self.stats['published']
+            return {
+                'connected': self.connected,
+                'queue_depth': len(self.queue) + self.spill_count,
+                'memory_messages': len(self.queue),
+                'memory_bytes': self.memory_bytes,
+                'spilled_messages': self.spill_count,
+                'published': published,
+                'dropped': self.stats['dropped'],
+                'spilled_total': self.stats['spilled'],
+                'batches': self.stats['batches'],
+                'reconnects': self.stats['reconnects'],
+                'publish_latency_ms': {
+                    'avg': round(self.stats['latency_total'] / published * 1000, 3) if published else 0,
+                    'max': round(self.stats['latency_max'] * 1000, 3),
+                    'last': round(self.stats['latency_last'] * 1000, 3)
+                }
+            }
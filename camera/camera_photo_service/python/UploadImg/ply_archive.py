@@ -0,0 +1,190 @@
+import os
+import shutil
+import struct
+import sys
+import time
+import zlib
+
+COPY_CHUNK_SIZE = 1024 * 1024
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_FLAG = 0x800
+# 生成压缩包的系统：0 为 MS-DOS/Windows，3 为 Unix，与 zipfile 一致，决定解压端如何解释外部属性
+CREATE_SYSTEM = 0 if sys.platform == 'win32' else 3
+
+
+def sample_ratio(path, level, sample_size, samples=3):
+    """
+    从文件开头、中间和末尾各取 sample_size 字节试压缩，返回压缩后/原始的比例。
+    二进制浮点点云通常接近1，ASCII点云通常远小于1。
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 1.0
+    raw = compressed = 0
+    with open(path, 'rb') as f:
+        for i in range(samples):
+            f.seek(max(0, (size - sample_size) * i // max(1, samples - 1)))
+            data = f.read(sample_size)
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            raw += len(data)
+            compressed += len(compressor.compress(data)) + len(compressor.flush())
+            if size <= sample_size:
+                break
+    return compressed / raw
+
+
+def compress_member(path, out_path, level, sample_size, store_ratio):
+    """
+    在工作进程中执行：压缩单个成员。
+    试压缩比例不低于 store_ratio 时不压缩（STORED），只计算CRC；
+    否则把原始DEFLATE数据写入 out_path。
+    返回成员信息：method、crc、size、compressed_size、data_path（成员数据所在文件）。
+    """
+    crc = 0
+    size = 0
+    if sample_ratio(path, level, sample_size) >= store_ratio:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+        return {'method': ZIP_STORED, 'crc': crc, 'size': size, 'compressed_size': size, 'data_path': path}
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed_size = 0
+    try:
+        with open(path, 'rb') as f, open(out_path, 'wb') as out:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                out.write(data)
+                compressed_size += len(data)
+            data = compressor.flush()
+            out.write(data)
+            compressed_size += len(data)
+    except Exception:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return {'method': ZIP_DEFLATED, 'crc': crc, 'size': size, 'compressed_size': compressed_size,
+            'data_path': out_path}
+
+
+def dos_datetime(timestamp):
+    """ZIP头中的 MS-DOS 日期和时间"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def local_header(entry):
+    """成员的本地文件头（大小超过4GB时带ZIP64扩展字段）"""
+    zip64 = entry['size'] >= ZIP64_LIMIT or entry['compressed_size'] >= ZIP64_LIMIT
+    extra = struct.pack('<HHQQ', 1, 16, entry['size'], entry['compressed_size']) if zip64 else b''
+    return struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, entry['flags'], entry['method'],
+        entry['time'], entry['date'], entry['crc'],
+        ZIP64_LIMIT if zip64 else entry['compressed_size'], ZIP64_LIMIT if zip64 else entry['size'],
+        len(entry['name']), len(extra)
+    ) + entry['name'] + extra
+
+
+def central_header(entry):
+    """成员的中央目录记录，超过4GB的大小和偏移放在ZIP64扩展字段中"""
+    values = []
+    size, compressed_size, offset = entry['size'], entry['compressed_size'], entry['offset']
+    if size >= ZIP64_LIMIT:
+        values.append(size)
+        size = ZIP64_LIMIT
+    if compressed_size >= ZIP64_LIMIT:
+        values.append(compressed_size)
+        compressed_size = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        values.append(offset)
+        offset = ZIP64_LIMIT
+    extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+    version = 45 if values else 20
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, (CREATE_SYSTEM << 8) | version, version, entry['flags'],
+        entry['method'], entry['time'], entry['date'], entry['crc'], compressed_size, size,
+        len(entry['name']), len(extra), 0, 0, 0, entry['external_attr'], offset
+    ) + entry['name'] + extra
+
+
+def end_records(count, cd_offset, cd_size):
+    """中央目录结束记录，条目数或偏移超出限制时先写ZIP64结束记录和定位符"""
+    records = b''
+    if count >= 0xFFFF or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+        zip64_offset = cd_offset + cd_size
+        records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+        count, cd_offset, cd_size = min(count, 0xFFFF), min(cd_offset, ZIP64_LIMIT), min(cd_size, ZIP64_LIMIT)
+    return records + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0)
+
+
+def build_zip(files, zip_path, level=6, sample_size=256 * 1024, store_ratio=0.9, pool=None):
+    """
+    把 files 打包为 zip_path（成员名为文件名），返回统计信息。
+    各文件由 pool（concurrent.futures 进程池，为空时在当前进程）并行压缩到临时文件，
+    再按顺序写入本地文件头、成员数据和中央目录组装成ZIP。
+    试压缩比例不低于 store_ratio 的文件不压缩，level 为 zlib 压缩级别（1-9）。
+    """
+    start = time.perf_counter()
+    jobs = [(path, f'{zip_path}.{i}.deflate', level, sample_size, store_ratio) for i, path in enumerate(files)]
+    members = []
+    error = None
+    futures = [pool.submit(compress_member, *job) for job in jobs] if pool is not None else None
+    for i, job in enumerate(jobs):
+        try:
+            members.append(futures[i].result() if futures else compress_member(*job))
+        except Exception as e:
+            # 等待其余成员结束，再统一清理已生成的临时文件
+            error = error or e
+            if not futures:
+                break
+
+    entries = []
+    try:
+        if error:
+            raise error
+        with open(zip_path, 'wb') as out:
+            for path, member in zip(files, members):
+                st = os.stat(path)
+                name = os.path.basename(path)
+                try:
+                    encoded, flags = name.encode('ascii'), 0
+                except UnicodeEncodeError:
+                    encoded, flags = name.encode('utf-8'), UTF8_FLAG
+                mod_time, mod_date = dos_datetime(st.st_mtime)
+                entry = dict(member, name=encoded, flags=flags, time=mod_time, date=mod_date,
+                             external_attr=(st.st_mode & 0xFFFF) << 16, offset=out.tell())
+                out.write(local_header(entry))
+                with open(member['data_path'], 'rb') as data:
+                    shutil.copyfileobj(data, out, COPY_CHUNK_SIZE)
+                entries.append(entry)
+
+            cd_offset = out.tell()
+            for entry in entries:
+                out.write(central_header(entry))
+            out.write(end_records(len(entries), cd_offset, out.tell() - cd_offset))
+    finally:
+        for member in members:
+            if member['method'] == ZIP_DEFLATED and os.path.exists(member['data_path']):
+                os.remove(member['data_path'])
+
+    size = sum(m['size'] for m in members)
+    compressed_size = sum(m['compressed_size'] for m in members)
+    return {
+        'files': len(members),
+        'deflated': sum(1 for m in members if m['method'] == ZIP_DEFLATED),
+        'stored': sum(1 for m in members if m['method'] == ZIP_STORED),
+        'bytes_in': size,
+        'bytes_out': os.path.getsize(zip_path),
+        'ratio': round(compressed_size / size, 4) if size else 1.0,
+        'seconds': round(time.perf_counter() - start, 3),
+        'level': level
+    }
@@ -0,0 +1,145 @@
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# PLY属性类型与NumPy类型的对应关系（字节序在读取时按文件格式补充）
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1',
+    'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2',
+    'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4',
+    'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4',
+    'double': 'f8', 'float64': 'f8'
+}
+NUMPY_TO_PLY = {
+    'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'
+}
+BYTE_ORDERS = {
+    'ascii': '<',
+    'binary_little_endian': '<',
+    'binary_big_endian': '>'
+}
+
+
+def read_ply_header(path):
+    """
+    解析PLY头部，返回字典：
+    format、header_size（头部字节数）、comments、
+    elements（[{name, count, properties: [(名称, 类型)], has_list}]）
+    """
+    header = {'format': None, 'comments': [], 'elements': []}
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f'不是PLY文件: {path}')
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f'PLY头部不完整: {path}')
+            words = line.decode('ascii', errors='replace').split()
+            if not words:
+                continue
+            keyword = words[0]
+            if keyword == 'end_header':
+                header['header_size'] = f.tell()
+                break
+            if keyword == 'format':
+                header['format'] = words[1]
+            elif keyword in ('comment', 'obj_info'):
+                header['comments'].append(line.decode('ascii', errors='replace').strip()[len(keyword) + 1:])
+            elif keyword == 'element':
+                header['elements'].append({
+                    'name': words[1],
+                    'count': int(words[2]),
+                    'properties': [],
+                    'has_list': False
+                })
+            elif keyword == 'property':
+                element = header['elements'][-1]
+                if words[1] == 'list':
+                    element['has_list'] = True
+                    element['properties'].append((words[4], 'list'))
+                else:
+                    element['properties'].append((words[2], words[1]))
+
+    if header['format'] not in BYTE_ORDERS:
+        raise ValueError(f'不支持的PLY格式: {header["format"]}')
+    return header
+
+
+def vertex_dtype(element, byte_order):
+    """顶点元素对应的NumPy结构化类型"""
+    return np.dtype([(name, byte_order + PLY_TYPES[ply_type]) for name, ply_type in element['properties']])
+
+
+def is_point_cloud(header):
+    """只有顶点、且顶点属性都是标量时才做压缩处理（网格的面索引会因降采样失效）"""
+    elements = header['elements']
+    return len(elements) == 1 and elements[0]['name'] == 'vertex' and not elements[0]['has_list']
+
+
+def read_vertices(path, header):
+    """读取顶点数据；二进制文件使用内存映射，不整体读入内存"""
+    element = header['elements'][0]
+    dtype = vertex_dtype(element, BYTE_ORDERS[header['format']])
+    if header['format'] == 'ascii':
+        with open(path, 'rb') as f:
+            f.seek(header['header_size'])
+            return np.loadtxt(f, dtype=dtype, max_rows=element['count'], ndmin=1)
+    return np.memmap(path, dtype=dtype, mode='r', offset=header['header_size'], shape=(element['count'],))
+
+
+def voxel_downsample(vertices, leaf_size):
+    """体素网格降采样：每个边长为 leaf_size 的体素只保留第一个点，保留全部属性"""
+    if leaf_size <= 0 or len(vertices) == 0:
+        return vertices
+    xyz = np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1).astype(np.float64)
+    keys = np.floor((xyz - xyz.min(axis=0)) / leaf_size).astype(np.int64)
+    _, first_index = np.unique(keys, axis=0, return_index=True)
+    first_index.sort()
+    return vertices[first_index]
+
+
+def write_binary_ply(path, vertices, comments=()):
+    """以 binary_little_endian 格式写出顶点"""
+    little_endian = np.dtype([(name, '<' + vertices.dtype[name].str[1:]) for name in vertices.dtype.names])
+    lines = ['ply', 'format binary_little_endian 1.0']
+    lines += [f'comment {comment}' for comment in comments]
+    lines.append(f'element vertex {len(vertices)}')
+    lines += [f'property {NUMPY_TO_PLY[little_endian[name].str[1:]]} {name}' for name in little_endian.names]
+    lines.append('end_header')
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(lines) + '\n').encode('ascii'))
+        vertices.astype(little_endian, copy=False).tofile(f)
+
+
+def compact_ply(src, output_dir, leaf_size=0.0):
+    """
+    压缩单个PLY文件：ASCII转为小端二进制，leaf_size > 0 时做体素降采样。
+    无需处理（已是小端二进制且不降采样）或不是纯点云时直接返回原文件。
+    返回 (输出路径, 统计信息)。
+    """
+    header = read_ply_header(src)
+    name = os.path.basename(src)
+    if not is_point_cloud(header):
+        logger.info(f"PLY文件包含非顶点元素，跳过压缩: {name}")
+        return src, {'file': name, 'points_before': None, 'points_after': None, 'compacted': False}
+
+    count = header['elements'][0]['count']
+    needs_conversion = header['format'] != 'binary_little_endian'
+    if not needs_conversion and leaf_size <= 0:
+        return src, {'file': name, 'points_before': count, 'points_after': count, 'compacted': False}
+
+    vertices = read_vertices(src, header)
+    if leaf_size > 0:
+        vertices = voxel_downsample(vertices, leaf_size)
+
+    dst = os.path.join(output_dir, name)
+    write_binary_ply(dst, vertices, header['comments'])
+    logger.info(f"PLY压缩完成: {name}, 点数 {count} -> {len(vertices)}")
+    return dst, {'file': name, 'points_before': count, 'points_after': len(vertices), 'compacted': True}
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkedTransferManager:
+    """
+    PLY压缩包的MQTT分块传输。
+
+    发送顺序：
+      1. 在分块主题上按顺序发送 total_chunks 条 ply_chunk 消息，每条包含
+         transfer_id、seq（从0开始）、offset、size、该块的sha256 和 base64 数据；
+      2. 在结果主题上发送 ply_files_manifest 消息，包含文件名、总大小、
+         整个文件的sha256、chunk_size、total_chunks 以及分块/重传主题。
+
+    订阅端重组：按 transfer_id 收集分块，校验每块的sha256后写入 offset 位置；
+    收到清单后检查 0..total_chunks-1 是否齐全，缺失的序号以
+    {"transfer_id": ..., "missing": [seq, ...]} 发布到重传主题，服务端会重发这些分块；
+    全部到齐后校验整个文件的sha256。
+    服务端在 ttl 秒内保留压缩包用于重传，发送时每次只读取一个分块到内存。
+    """
+
+    def __init__(self, folder, publish, chunk_size=256 * 1024, ttl=3600,
+                 chunk_topic='ply/files/chunks', resend_topic='ply/files/resend'):
+        self.folder = folder
+        self.publish = publish  # publish(message, topic=None) -> bool，topic为空时发到结果主题
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.chunk_topic = chunk_topic
+        self.resend_topic = resend_topic
+        self.lock = Lock()
+        self.transfers = {}
+        os.makedirs(folder, exist_ok=True)
+        # 重启后旧的传输记录已丢失，遗留的压缩包无法再重传
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+
+    def start(self, zip_path, task_id, project_name=None, extra=None, file_name=None, move=True):
+        """
+        分块发送压缩包，返回清单消息。
+        move 为真时接管（移动）压缩包，否则链接或复制一份，原文件由调用方管理；
+        extra 中的字段附加到清单消息。
+        """
+        self.cleanup_expired()
+        transfer_id = str(uuid.uuid4())
+        file_name = file_name or os.path.basename(zip_path)
+        path = os.path.join(self.folder, f'{transfer_id}.zip')
+        if move:
+            os.replace(zip_path, path)
+        else:
+            try:
+                os.link(zip_path, path)
+            except OSError:
+                shutil.copyfile(zip_path, path)
+
+        size = os.path.getsize(path)
+        total_chunks = max(1, (size + self.chunk_size - 1) // self.chunk_size)
+        transfer = {
+            'path': path,
+            'task_id': task_id,
+            'total_chunks': total_chunks,
+            'expires': time.time() + self.ttl
+        }
+        with self.lock:
+            self.transfers[transfer_id] = transfer
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for seq in range(total_chunks):
+                data = f.read(self.chunk_size)
+                sha256.update(data)
+                self._send_chunk(transfer_id, task_id, seq, total_chunks, data)
+
+        manifest = {
+            'type': 'ply_files_manifest',
+            'task_id': task_id,
+            'transfer_id': transfer_id,
+            'fileName': file_name,
+            'size': size,
+            'sha256': sha256.hexdigest(),
+            'chunk_size': self.chunk_size,
+            'total_chunks': total_chunks,
+            'chunk_topic': self.chunk_topic,
+            'resend_topic': self.resend_topic,
+            'project_name': project_name,
+            'timestamp': datetime.now().isoformat()
+        }
+        manifest.update(extra or {})
+        self.publish(manifest)
+        logger.info(f"分块发送完成 - TaskID: {task_id}, 传输ID: {transfer_id}, 分块数: {total_chunks}")
+        return manifest
+
+    def _send_chunk(self, transfer_id, task_id, seq, total_chunks, data):
+        import base64
+
+        self.publish({
+            'type': 'ply_chunk',
+            'task_id': task_id,
+            'transfer_id': transfer_id,
+            'seq': seq,
+            'total_chunks': total_chunks,
+            'offset': seq * self.chunk_size,
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'data': base64.b64encode(data).decode('utf-8')
+        }, topic=self.chunk_topic)
+
+    def resend(self, transfer_id, seqs):
+        """重发指定序号的分块，返回实际重发的数量"""
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+        if not transfer:
+            logger.warning(f"重传请求的传输不存在或已过期: {transfer_id}")
+            return 0
+
+        sent = 0
+        total_chunks = transfer['total_chunks']
+        with open(transfer['path'], 'rb') as f:
+            for seq in sorted({s for s in seqs if isinstance(s, int) and 0 <= s < total_chunks}):
+                f.seek(seq * self.chunk_size)
+                self._send_chunk(transfer_id, transfer['task_id'], seq, total_chunks, f.read(self.chunk_size))
+                sent += 1
+        logger.info(f"已重发分块 - 传输ID: {transfer_id}, 数量: {sent}")
+        return sent
+
+    def cleanup_expired(self):
+        """删除超过保留时间的压缩包"""
+        now = time.time()
+        with self.lock:
+            expired = [tid for tid, t in self.transfers.items() if t['expires'] < now]
+            paths = [self.transfers.pop(tid)['path'] for tid in expired]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def active_count(self):
+        with self.lock:
+            return len(self.transfers)
@@ -0,0 +1,212 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+# inotify 事件掩码
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """通过ctypes调用Linux inotify，监听单个目录"""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch 失败: {path}')
+
+    def read_events(self, timeout):
+        """等待最多 timeout 秒，返回 [(文件名, 掩码)]"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', errors='replace')
+            offset += length
+            events.append((name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PlyWatcher:
+    """
+    监听PLY输出目录，重建完成后通知等待中的任务。
+    Linux下使用inotify，其他平台或inotify不可用时退回定时轮询。
+    文件写完的判定：大小和修改时间连续 stable_seconds 秒不变，
+    并且（有inotify时）最后一次修改之后已收到写关闭事件。
+    """
+
+    def __init__(self, path, on_ready, on_timeout, stable_seconds=3, poll_interval=1.0):
+        self.path = path
+        self.on_ready = on_ready  # on_ready(task)：PLY文件就绪时为每个等待中的任务调用
+        self.on_timeout = on_timeout  # on_timeout(task)：等待超时时调用
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self.files = {}  # 文件名 -> {size, mtime, stable_since, modified, closed}
+        self.pending = {}  # task_id -> {task_id, project_name, deadline}
+        self.inotify = None
+        self.running = False
+        self.thread = None
+
+    @property
+    def mode(self):
+        return 'inotify' if self.inotify else 'polling'
+
+    def start(self):
+        """启动后台监听线程"""
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True, name='ply-watcher')
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def wait_for(self, task_id, project_name, timeout):
+        """登记等待PLY结果的任务"""
+        with self.lock:
+            self.pending[task_id] = {
+                'task_id': task_id,
+                'project_name': project_name,
+                'deadline': time.time() + timeout
+            }
+        logger.info(f"等待PLY文件生成 - TaskID: {task_id}, 监听模式: {self.mode}")
+
+    def is_pending(self, task_id):
+        with self.lock:
+            return task_id in self.pending
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def files_ready(self):
+        """目录中至少有一个PLY文件且全部已写完"""
+        with self.lock:
+            self._scan()
+            return self._ready()
+
+    def _try_inotify(self):
+        if self.inotify or not sys.platform.startswith('linux') or not os.path.isdir(self.path):
+            return
+        try:
+            self.inotify = Inotify(self.path)
+            logger.info(f"PLY目录监听使用inotify: {self.path}")
+        except OSError as e:
+            logger.warning(f"inotify不可用，使用轮询: {str(e)}")
+
+    def _run(self):
+        self._try_inotify()
+        while self.running:
+            if self.inotify:
+                events = self.inotify.read_events(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+                events = []
+                self._try_inotify()
+            with self.lock:
+                self._apply_events(events)
+                self._scan()
+                ready, expired = self._collect()
+            for task in ready:
+                self._call(self.on_ready, task)
+            for task in expired:
+                self._call(self.on_timeout, task)
+
+    def _call(self, callback, task):
+        try:
+            callback(task)
+        except Exception as e:
+            logger.error(f"PLY监听回调失败 - TaskID: {task['task_id']}: {str(e)}")
+
+    def _apply_events(self, events):
+        now = time.time()
+        for name, mask in events:
+            if not name.lower().endswith('.ply'):
+                continue
+            state = self.files.setdefault(name, {'size': -1, 'mtime': 0, 'stable_since': now,
+                                                 'modified': now, 'closed': 0})
+            if mask & (IN_MODIFY | IN_CREATE):
+                state['modified'] = now
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                state['closed'] = now
+
+    def _scan(self):
+        """刷新目录中PLY文件的大小和修改时间"""
+        now = time.time()
+        try:
+            names = [n for n in os.listdir(self.path) if n.lower().endswith('.ply')]
+        except OSError:
+            names = []
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            state = self.files.get(name)
+            if state is None:
+                # 监听开始前就存在的文件视为已关闭，只依赖大小稳定判断
+                self.files[name] = {'size': st.st_size, 'mtime': st.st_mtime, 'stable_since': now,
+                                    'modified': 0, 'closed': 0}
+                continue
+            if (state['size'], state['mtime']) != (st.st_size, st.st_mtime):
+                state.update(size=st.st_size, mtime=st.st_mtime, stable_since=now)
+
+    def _ready(self):
+        if not self.files:
+            return False
+        now = time.time()
+        for state in self.files.values():
+            if now - state['stable_since'] < self.stable_seconds:
+                return False
+            if self.inotify and state['closed'] < state['modified']:
+                return False
+        return True
+
+    def _collect(self):
+        """取出可以通知的任务和已超时的任务"""
+        if not self.pending:
+            return [], []
+        if self._ready():
+            ready = list(self.pending.values())
+            self.pending.clear()
+            return ready, []
+        now = time.time()
+        expired = [t for t in self.pending.values() if t['deadline'] < now]
+        for task in expired:
+            del self.pending[task['task_id']]
+        return [], expired
@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class PlyResultStore:
+    """
+    按内容哈希保存PLY压缩包，供订阅端通过HTTP下载（引用传输模式）。
+    压缩包保存为 <folder>/<sha256>.zip，内容相同的结果只保存一份；
+    超过 ttl 秒未再次生成的压缩包在下次保存时删除。
+    文件名只由内容决定，多个进程可以共用同一目录。
+    """
+
+    def __init__(self, folder, ttl=7 * 24 * 3600):
+        self.folder = folder
+        self.ttl = ttl
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, sha256):
+        """压缩包路径，哈希格式无效或文件不存在时返回 None"""
+        if not SHA256_PATTERN.match(sha256):
+            return None
+        path = os.path.join(self.folder, f'{sha256}.zip')
+        return path if os.path.exists(path) else None
+
+    def put(self, zip_path, move=True):
+        """
+        保存压缩包，返回 (sha256, 大小)。
+        move 为真时接管（移动）压缩包，否则链接或复制一份，原文件由调用方管理。
+        """
+        self.cleanup_expired()
+        sha256 = hashlib.sha256()
+        with open(zip_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        size = os.path.getsize(zip_path)
+
+        path = os.path.join(self.folder, f'{digest}.zip')
+        if os.path.exists(path):
+            # 相同内容已保存过，只刷新保留时间
+            os.utime(path)
+            if move:
+                os.remove(zip_path)
+            return digest, size
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        if move:
+            shutil.move(zip_path, tmp_path)
+        else:
+            try:
+                os.link(zip_path, tmp_path)
+            except OSError:
+                shutil.copyfile(zip_path, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"PLY压缩包已保存: {digest}.zip, 大小: {size}")
+        return digest, size
+
+    def cleanup_expired(self):
+        """删除超过保留时间的压缩包"""
+        deadline = time.time() - self.ttl
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    logger.info(f"删除过期PLY压缩包: {name}")
+            except OSError:
+                continue  # 已被其他进程删除，或正在被下载（Windows下无法删除）
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    """
+    上传图片的缩略图缓存。
+    缩略图以 原图相对路径、大小、修改时间 和缩略图参数的哈希为键保存在 <folder>/<键前两位>/<键>.jpg，
+    该键同时作为HTTP ETag，判断客户端缓存是否有效只需要 stat 原图，不需要解码。
+    生成时使用Pillow的JPEG draft模式，解码阶段直接按1/2、1/4、1/8缩小（DCT域降采样），
+    不解码完整分辨率的像素。缓存总大小超过上限时按最近访问时间淘汰到 max_bytes * low_watermark，
+    留出余量，之后的多次生成都不需要再扫描目录。
+    多个进程可以共用同一个缓存目录：文件先写临时文件再原子替换，淘汰时重新扫描目录。
+    启动时不扫描目录，总大小在第一次生成缩略图时统计。
+    """
+
+    def __init__(self, folder, source_root, max_bytes, size=256, quality=80, low_watermark=0.9):
+        self.folder = folder
+        self.source_root = source_root
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.size = size
+        self.quality = quality
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'generate_ms_total': 0.0}
+        os.makedirs(folder, exist_ok=True)
+        self.total_bytes = None  # 未统计
+
+    def _scan(self):
+        """缓存目录中的缩略图：(路径, 大小, 最近访问时间)"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.folder):
+            for name in filenames:
+                if not name.endswith('.jpg'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def source_path(self, rel_path):
+        return os.path.join(self.source_root, rel_path)
+
+    def etag(self, rel_path):
+        """原图对应缩略图的ETag（缓存键），原图不存在时抛出 FileNotFoundError"""
+        st = os.stat(self.source_path(rel_path))
+        key = f'{rel_path}|{st.st_size}|{st.st_mtime_ns}|{self.size}|{self.quality}'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def _cache_path(self, key):
+        return os.path.join(self.folder, key[:2], f'{key}.jpg')
+
+    def get(self, rel_path):
+        """返回 (缩略图路径, ETag)，缓存中没有时生成"""
+        key = self.etag(rel_path)
+        path = self._cache_path(key)
+        try:
+            # 用修改时间记录最近访问时间，供淘汰时排序
+            os.utime(path)
+            with self.lock:
+                self.stats['hits'] += 1
+            return path, key
+        except FileNotFoundError:
+            pass
+
+        start = time.perf_counter()
+        size = self._generate(self.source_path(rel_path), path)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['generate_ms_total'] += elapsed_ms
+            if self.total_bytes is not None:
+                self.total_bytes += size
+            over = self.total_bytes is None or self.total_bytes > self.max_bytes
+        if over:
+            self._evict(keep=path)
+        return path, key
+
+    def _generate(self, source_path, path):
+        """生成缩略图写入 path，返回文件大小"""
+        from PIL import Image
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Image.open(source_path) as image:
+            # draft 只对JPEG有效，让解码器直接输出不小于目标尺寸的最小缩放比例
+            image.draft('RGB', (self.size, self.size))
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, 'JPEG', quality=self.quality, optimize=False)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return os.path.getsize(path)
+
+    def _evict(self, keep):
+        """重新统计总大小，超过上限时按最近访问时间淘汰到低水位"""
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_watermark if total > self.max_bytes else total
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # 已被其他进程删除或正在发送
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.total_bytes = total
+            self.stats['evictions'] += evicted
+        if evicted:
+            logger.info(f"淘汰缩略图缓存: {evicted} 个")
+
+    def get_stats(self):
+        with self.lock:
+            misses = self.stats['misses']
+            return {
+                'hits': self.stats['hits'],
+                'misses': misses,
+                'evictions': self.stats['evictions'],
+                'avg_generate_ms': round(self.stats['generate_ms_total'] / misses, 3) if misses else 0,
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes
+            }
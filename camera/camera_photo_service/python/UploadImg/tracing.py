@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """
+    按 task_id 记录处理阶段的 span：阶段名、开始/结束时间（Unix时间戳）、耗时、字节数和附加属性。
+    最近 capacity 个 span 保存在进程内的环形缓冲区中，可按 task_id 查询；
+    log_path 非空时每个 span 另追加一行JSON，多个进程可以共用同一个文件（每个 span 一次打开、写入、关闭，
+    轮转后各进程自然写入新文件）。文件超过 max_bytes 时轮转为 .1 … .<backups>，最旧的删除。
+    """
+
+    def __init__(self, capacity=10000, log_path=None, max_bytes=16 * 1024 * 1024, backups=3):
+        self.spans = deque(maxlen=capacity)
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, task_id, name, **attrs):
+        """
+        记录 with 块为一个 span（异常时也记录，并带上 error）。
+        返回的字典可在块内补充 bytes 等字段。
+        """
+        span = {'task_id': task_id, 'name': name, 'start': time.time(), 'bytes': 0, **attrs}
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = str(e)
+            raise
+        finally:
+            span['seconds'] = round(time.perf_counter() - start, 6)
+            span['end'] = span['start'] + span['seconds']
+            self.record(span)
+
+    def record(self, span):
+        span['pid'] = os.getpid()
+        line = json.dumps(span, ensure_ascii=False) + '\n' if self.log_path else None
+        with self.lock:
+            self.spans.append(span)
+            if line is None:
+                return
+            try:
+                self._rotate()
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError as e:
+                logger.error(f"写入跟踪日志失败: {str(e)}")
+
+    def _rotate(self):
+        """文件超过 max_bytes 时轮转；其他进程正在写入（Windows下无法重命名）时下次再试"""
+        try:
+            if os.path.getsize(self.log_path) < self.max_bytes:
+                return
+        except FileNotFoundError:
+            return
+        try:
+            for i in range(self.backups, 0, -1):
+                source = self.log_path if i == 1 else f'{self.log_path}.{i - 1}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.log_path}.{i}')
+            if not self.backups:
+                os.remove(self.log_path)
+        except OSError:
+            pass
+
+    def _log_files(self):
+        """跟踪日志文件，从新到旧"""
+        paths = [self.log_path] + [f'{self.log_path}.{i}' for i in range(1, self.backups + 1)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def get(self, task_id):
+        """
+        任务的全部 span（按开始时间排序）。
+        本进程缓冲区中没有时（多进程模式下由其他进程处理，或已被挤出缓冲区）从跟踪日志中从新到旧查找，
+        在找到该任务的文件及其前一个文件（任务跨越轮转时）之后停止。
+        """
+        with self.lock:
+            spans = [span for span in self.spans if span['task_id'] == task_id]
+        if not spans and self.log_path:
+            found_in = None
+            for index, path in enumerate(self._log_files()):
+                if found_in is not None and index > found_in + 1:
+                    break
+                try:
+                    matched = [span for span in self._read_matching(path, task_id) if span['task_id'] == task_id]
+                except OSError:
+                    continue  # 正在轮转
+                if matched:
+                    spans.extend(matched)
+                    if found_in is None:
+                        found_in = index
+        return sorted(spans, key=lambda span: span['start'])
+
+    @staticmethod
+    def _read_matching(path, task_id):
+        """读取文件中包含 task_id 的行（先按子串筛选再解析），跳过其他进程写了一半的行"""
+        spans = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if task_id not in line:
+                    continue
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+        return spans
+
+    def tasks(self, min_seconds=0.0, limit=50):
+        """
+        缓冲区中各任务的概况，按总耗时从长到短排列：
+        起止时间、总耗时、span 数、字节数，以及耗时最长的阶段。
+        """
+        with self.lock:
+            spans = list(self.spans)
+        tasks = {}
+        for span in spans:
+            task = tasks.get(span['task_id'])
+            if task is None:
+                task = tasks[span['task_id']] = {'task_id': span['task_id'], 'start': span['start'],
+                                                 'end': span['end'], 'spans': 0, 'bytes': 0,
+                                                 'errors': 0, 'slowest': None}
+            task['start'] = min(task['start'], span['start'])
+            task['end'] = max(task['end'], span['end'])
+            task['spans'] += 1
+            task['bytes'] += span['bytes']
+            task['errors'] += 'error' in span
+            if task['slowest'] is None or span['seconds'] > task['slowest']['seconds']:
+                task['slowest'] = {'name': span['name'], 'seconds': span['seconds']}
+        for task in tasks.values():
+            task['seconds'] = round(task['end'] - task['start'], 6)
+        result = sorted((t for t in tasks.values() if t['seconds'] >= min_seconds),
+                        key=lambda t: t['seconds'], reverse=True)
+        return result[:limit]
@@ -0,0 +1,296 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class SessionError(Exception):
+    """断点续传会话错误，附带HTTP状态码"""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
+
+
+def merge_ranges(ranges):
+    """合并已接收的字节区间，区间为左闭右开 [start, end)"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(received, size):
+    """根据已接收区间计算缺失区间"""
+    missing = []
+    position = 0
+    for start, end in received:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    received TEXT NOT NULL DEFAULT '[]',
+    metadata TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    finalizing INTEGER NOT NULL DEFAULT 0,
+    writers INTEGER NOT NULL DEFAULT 0,
+    write_lease_until REAL,
+    batch_key TEXT,
+    closes_batch INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated);
+'''
+
+# 旧版本数据库中没有的列，启动时补上
+ADDED_COLUMNS = (
+    ('writers', 'INTEGER NOT NULL DEFAULT 0'),
+    ('write_lease_until', 'REAL'),
+    ('batch_key', 'TEXT'),
+    ('closes_batch', 'INTEGER NOT NULL DEFAULT 0'),
+)
+
+
+class UploadSessionStore:
+    """
+    断点续传会话存储。
+    每个会话在 <root>/<session_id>.part 中按偏移写入数据，
+    <root>/sessions.db 记录文件元数据和已接收的字节区间，服务重启后可继续上传。
+    元数据的更新在SQLite事务中完成，多个HTTP工作进程可以同时接收同一会话的分片。
+    写入分片期间持有写租约（writers 计数，write_lease 秒后过期，防止进程退出后会话永远无法落盘），
+    有分片正在写入时会话不能被领取落盘，由最后写完的请求领取。
+    同一批次的会话用 batch_key 关联，closes_batch 表示该会话完成时负责记录批次（见 complete）。
+    """
+
+    def __init__(self, root, ttl=24 * 3600, write_lease=600):
+        self.root = root
+        self.ttl = ttl
+        self.write_lease = write_lease
+        self.db_path = os.path.join(root, 'sessions.db')
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(sessions)')}
+            for name, definition in ADDED_COLUMNS:
+                if name not in columns:
+                    conn.execute(f'ALTER TABLE sessions ADD COLUMN {name} {definition}')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_batch ON sessions (batch_key)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def part_path(self, session_id):
+        return os.path.join(self.root, f'{session_id}.part')
+
+    def _to_dict(self, row):
+        session = {
+            'session_id': row['session_id'],
+            'size': row['size'],
+            'received': json.loads(row['received']),
+            'metadata': json.loads(row['metadata']),
+            'created': row['created'],
+            'updated': row['updated']
+        }
+        if row['finalizing']:
+            session['finalizing'] = True
+        return session
+
+    def _load(self, session_id, conn=None):
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            raise SessionError('会话ID无效', 404)
+        if conn is None:
+            with self._connect() as conn:
+                return self._load(session_id, conn)
+        row = conn.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            raise SessionError('上传会话不存在或已过期', 404)
+        return self._to_dict(row)
+
+    def create(self, size, metadata, batch_key=None, closes_batch=False):
+        """
+        创建上传会话，返回会话信息。
+        batch_key 标识会话所属的项目批次，closes_batch 为真表示客户端标记的批次最后一个文件。
+        """
+        if size <= 0:
+            raise SessionError('文件大小无效')
+        self.cleanup_expired()
+
+        session_id = str(uuid.uuid4())
+        now = time.time()
+        # 预分配分片文件，后续分片按偏移写入
+        with open(self.part_path(session_id), 'wb') as f:
+            f.truncate(size)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO sessions (session_id, size, metadata, created, updated, batch_key, closes_batch) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (session_id, size, json.dumps(metadata, ensure_ascii=False), now, now, batch_key, int(closes_batch))
+            )
+        logger.info(f"创建上传会话: {session_id}, 大小: {size}")
+        return self.get(session_id)
+
+    def get(self, session_id):
+        """获取会话信息"""
+        return self._load(session_id)
+
+    def write_chunk(self, session_id, offset, chunks, max_length=None):
+        """
+        从 offset 处写入一个分片，chunks 为字节块的可迭代对象。
+        返回更新后的会话信息。
+        分片数据直接写入分片文件的对应位置（不同分片互不重叠），只在登记写租约和记录已接收区间时加锁。
+        检查会话未在落盘和登记写租约在同一事务中完成，租约释放前会话不会被领取落盘，
+        分片文件在计算哈希和移动期间不会被修改。
+        """
+        with self._transaction() as conn:
+            session = self._load(session_id, conn)
+            if session.get('finalizing'):
+                raise SessionError('文件正在校验落盘，请稍后查询会话状态', 409)
+            size = session['size']
+            if offset < 0 or offset >= size:
+                raise SessionError(f'分片偏移无效: {offset}', 416)
+            now = time.time()
+            # 租约已过期的写入者（进程已退出）不再计数
+            conn.execute(
+                'UPDATE sessions SET writers = CASE WHEN write_lease_until < ? THEN 1 ELSE writers + 1 END, '
+                'write_lease_until = ? WHERE session_id = ?',
+                (now, now + self.write_lease, session_id)
+            )
+
+        written = 0
+        try:
+            with open(self.part_path(session_id), 'r+b') as f:
+                f.seek(offset)
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if offset + written + len(chunk) > size:
+                        raise SessionError('分片超出文件大小', 416)
+                    if max_length is not None and written + len(chunk) > max_length:
+                        raise SessionError(f'分片超过大小限制 {max_length} 字节', 413)
+                    f.write(chunk)
+                    written += len(chunk)
+        except FileNotFoundError:
+            self._release_write(session_id)
+            raise SessionError('上传会话不存在或已过期', 404)
+        except BaseException:
+            self._release_write(session_id)
+            raise
+        session = self._release_write(session_id, [offset, offset + written] if written else None)
+        if session is None:
+            raise SessionError('上传会话不存在或已过期', 404)
+        return session
+
+    def _release_write(self, session_id, received=None):
+        """释放写租约，received 非空时同时记录已接收的区间；返回更新后的会话信息，会话已被删除时返回 None"""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return None
+            session = self._to_dict(row)
+            if received:
+                session['received'] = merge_ranges(session['received'] + [received])
+                session['updated'] = time.time()
+            conn.execute('UPDATE sessions SET received = ?, updated = ?, writers = MAX(writers - 1, 0) '
+                         'WHERE session_id = ?',
+                         (json.dumps(session['received']), session['updated'], session_id))
+        return session
+
+    def is_complete(self, session):
+        """所有字节是否都已接收"""
+        return session['received'] == [[0, session['size']]]
+
+    def claim_completed(self, session_id):
+        """
+        领取已接收完整的会话用于落盘，并发的最后分片中只有一个请求能领取成功。
+        未完成、已被领取或还有分片正在写入（由最后写完的请求领取）时返回 None。
+        """
+        with self._transaction() as conn:
+            session = self._load(session_id, conn)
+            if not self.is_complete(session) or session.get('finalizing'):
+                return None
+            row = conn.execute('SELECT writers, write_lease_until FROM sessions WHERE session_id = ?',
+                               (session_id,)).fetchone()
+            if row['writers'] and row['write_lease_until'] >= time.time():
+                return None
+            conn.execute('UPDATE sessions SET finalizing = 1 WHERE session_id = ?', (session_id,))
+        session['finalizing'] = True
+        return session
+
+    def release(self, session_id):
+        """落盘失败后释放领取，会话保持完整状态，客户端重发任一分片时重新落盘"""
+        with self._connect() as conn:
+            conn.execute('UPDATE sessions SET finalizing = 0 WHERE session_id = ?', (session_id,))
+
+    def complete(self, session_id):
+        """
+        删除已落盘的会话，返回是否由它记录批次：
+        负责记录批次的会话完成时，同批次还有未完成的会话则把责任转交给它们，由最后完成的会话记录，
+        避免批次在其他文件还在上传时就被计入（项目收齐后PLY处理会提前开始）。
+        """
+        with self._transaction() as conn:
+            return self._delete(conn, session_id)
+
+    def _delete(self, conn, session_id):
+        row = conn.execute('SELECT batch_key, closes_batch FROM sessions WHERE session_id = ?',
+                           (session_id,)).fetchone()
+        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        if row is None or not row['closes_batch']:
+            return False
+        if row['batch_key'] is None:
+            return True
+        return conn.execute('UPDATE sessions SET closes_batch = 1 WHERE batch_key = ?',
+                            (row['batch_key'],)).rowcount == 0
+
+    def remove(self, session_id):
+        """删除会话及其分片文件；负责记录批次的会话被放弃时，责任转交给同批次其他未完成的会话"""
+        with self._transaction() as conn:
+            self._delete(conn, session_id)
+        try:
+            os.remove(self.part_path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def cleanup_expired(self):
+        """清理超过有效期未更新的会话"""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT session_id FROM sessions WHERE updated < ?',
+                                (time.time() - self.ttl,)).fetchall()
+        for row in rows:
+            logger.info(f"清理过期上传会话: {row['session_id']}")
+            self.remove(row['session_id'])
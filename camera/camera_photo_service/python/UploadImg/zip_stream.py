@@ -0,0 +1,58 @@
+import logging
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+
+class _ChunkBuffer:
+    """
+    zipfile 的输出对象，只有 write 和 flush，没有 tell/seek。
+    zipfile 发现输出不可定位时不回填本地文件头，而是在每个成员数据后写数据描述符（CRC和大小）。
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(members, chunk_size=64 * 1024, compression=zipfile.ZIP_STORED):
+    """
+    边读文件边生成ZIP，逐块产出字节，不写临时文件，内存占用只与 chunk_size 有关。
+    members 为 (本地路径, 压缩包内名称) 的可迭代对象，可以是惰性的查询结果；
+    打开失败的文件（已被删除等）跳过。大小或偏移超过4GB时自动使用ZIP64。
+    JPEG已经是压缩数据，默认原样存储（STORED）。
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=compression, allowZip64=True) as zf:
+        for path, arcname in members:
+            try:
+                # file_size 取自文件当前大小，zipfile 据此决定该成员是否需要ZIP64
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, 'rb')
+            except OSError as e:
+                logger.warning(f"导出时跳过文件 {path}: {str(e)}")
+                continue
+            zinfo.compress_type = compression
+            with src, zf.open(zinfo, 'w') as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+            # 数据描述符
+            data = buffer.take()
+            if data:
+                yield data
+    # 中央目录和结束记录
+    yield buffer.take()